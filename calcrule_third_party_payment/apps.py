@@ -3,14 +3,83 @@ from django.apps import AppConfig
 from calculation.apps import CALCULATION_RULES, read_all_calculation_rules
 
 MODULE_NAME = "calcrule_third_party_payment"
-DEFAULT_CFG = {}
+DEFAULT_CFG = {
+    # convert the health facilities of a batch run in a worker pool
+    "parallel_conversion": False,
+    "parallel_conversion_workers": 4,
+    # save the bills of a batch run with bulk inserts, by chunk of health facilities
+    "bulk_bill_creation": False,
+    "bulk_bill_creation_chunk_size": 100,
+    "bulk_bill_creation_batch_size": 1000,
+    # max number of check_calculation results kept in memory, 0 to disable
+    "check_calculation_cache_size": 10000,
+    # max number of items/services updated per statement by the valuation, 0 for no limit
+    "valuation_update_chunk_size": 10000,
+    # build and save the bill line items by chunks of claims
+    "streaming_conversion": False,
+    "streaming_chunk_size": 1000,
+    # split the bills of a batch run over these limits, 0 for no limit
+    "bill_max_lines": 0,
+    "bill_max_amount": 0,
+    # max number of eligible claim ids kept as a list (staged in a table above it),
+    # 0 to always use a subquery
+    "materialized_claim_ids_max_size": 900,
+    # record the time, queries and rows of each phase of the batch calculations
+    "instrumentation": False,
+    # write cProfile stats and tracemalloc top allocations of the batch calculations
+    # of these contexts (BatchPayment, BatchValuate) or payment plans (uuid)
+    "profiling_contexts": [],
+    "profiling_payment_plans": [],
+    "profiling_directory": None,
+    # run the BatchPayment conversion as a resumable background job
+    "background_conversion": False,
+    # thread (pool of background_conversion_workers) or inline (in-process, after commit)
+    "background_conversion_executor": "thread",
+    "background_conversion_workers": 1,
+    # commit the bills and the claims of each health facility in one transaction
+    "per_facility_commit": False,
+    # max number of claims updated per statement when committing a health facility, 0 for no limit
+    "remuneration_update_chunk_size": 1000,
+}
 
 
 class CalcruleThirdPartyPaymentConfig(AppConfig):
     name = MODULE_NAME
 
+    parallel_conversion = False
+    parallel_conversion_workers = 4
+    bulk_bill_creation = False
+    bulk_bill_creation_chunk_size = 100
+    bulk_bill_creation_batch_size = 1000
+    check_calculation_cache_size = 10000
+    valuation_update_chunk_size = 10000
+    streaming_conversion = False
+    streaming_chunk_size = 1000
+    bill_max_lines = 0
+    bill_max_amount = 0
+    materialized_claim_ids_max_size = 900
+    instrumentation = False
+    profiling_contexts = []
+    profiling_payment_plans = []
+    profiling_directory = None
+    background_conversion = False
+    background_conversion_executor = "thread"
+    background_conversion_workers = 1
+    per_facility_commit = False
+    remuneration_update_chunk_size = 1000
+
+    def __load_config(self, cfg):
+        for field in cfg:
+            if hasattr(CalcruleThirdPartyPaymentConfig, field):
+                setattr(CalcruleThirdPartyPaymentConfig, field, cfg[field])
+
     def ready(self):
         from core.models import ModuleConfiguration
 
-        ModuleConfiguration.get_or_default(MODULE_NAME, DEFAULT_CFG)
+        cfg = ModuleConfiguration.get_or_default(MODULE_NAME, DEFAULT_CFG)
+        self.__load_config(cfg)
         read_all_calculation_rules(MODULE_NAME, CALCULATION_RULES)
+
+        from calcrule_third_party_payment.signals import bind_cache_invalidation
+
+        bind_cache_invalidation()
@@ -1,37 +1,67 @@
 import logging
-import operator
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import nullcontext
+from datetime import datetime as py_datetime
 from uuid import UUID
 
-from django.contrib.contenttypes.models import ContentType
-from django.db.models import Q, Subquery
+from django.db import connection, connections, transaction
+from django.db.models import Exists, OuterRef, Q, Subquery
 from django.utils.translation import gettext as _
 
-
+from calcrule_third_party_payment.apps import CalcruleThirdPartyPaymentConfig
 from calcrule_third_party_payment.config import (
     CLASS_RULE_PARAM_VALIDATION,
     CONTEXTS,
     DESCRIPTION_CONTRIBUTION_VALUATION,
     FROM_TO,
-    INTEGER_PARAMETERS,
-    NONE_INTEGER_PARAMETERS,
 )
 from calcrule_third_party_payment.converters import (
     ClaimsToBillConverter,
     ClaimToBillItemConverter,
 )
+from calcrule_third_party_payment.converters.bill_line_item import to_bill_data_lines
+from calcrule_third_party_payment.instrumentation import (
+    add_rows,
+    phase,
+    record_calculation,
+)
+from calcrule_third_party_payment.jobs import EXECUTOR_INLINE, submit_conversion_job
+from calcrule_third_party_payment.models import (
+    ConversionCheckpoint,
+    ConversionJob,
+    StagedClaim,
+)
+from calcrule_third_party_payment.profiling import profile_calculation
+from calcrule_third_party_payment.services import (
+    bulk_create_bills,
+    create_bill_streaming,
+)
 from calcrule_third_party_payment.utils import (
-    check_bill_exist,
+    annotate_claim_product,
+    check_calculation_cache,
     claim_batch_valuation,
-    get_hospital_level_filter,
+    get_billed_claim_ids,
+    get_compiled_payment_plan,
+    get_health_facility_bill_totals,
+    get_health_facility_products,
+    get_linked_class_map,
+    get_next_rerun_number,
+    has_billed_claims,
+    iter_pk_range_chunks,
+    materialize_claim_ids,
+    release_staged_claims,
+    stage_claim_ids,
+    simulate_claim_batch_valuation,
 )
-from claim.models import ClaimItem, ClaimService
+from claim.models import Claim
+from claim_batch.models import BatchRun
 from claim_batch.services import (
-    get_hospital_claim_filter,
+    product_content_type,
     update_claim_valuated,
-    update_claim_indexed_remunerated
+    update_claim_indexed_remunerated,
+    update_work_data,
 )
 from contribution_plan.models import PaymentPlan
-from contribution_plan.utils import obtain_calcrule_params
 from core import datetime
 from core.abs_calculation_rule import AbsStrategy
 from core.models import User
@@ -41,6 +71,15 @@ from product.models import Product
 
 logger = logging.getLogger(__name__)
 
+# the claims are not cached: their match depends on the product of their items and
+# services, set when they are processed (often with queryset updates, no signal)
+CACHED_CHECK_CALCULATION_CLASSES = [
+    "BatchRun",
+    "HealthFacility",
+    "Location",
+    "Product",
+]
+
 
 class ThirdPartyPaymentCalculationRule(AbsStrategy):
     version = 1
@@ -67,6 +106,19 @@ class ThirdPartyPaymentCalculationRule(AbsStrategy):
 
     @classmethod
     def check_calculation(cls, instance):
+        class_name = instance.__class__.__name__
+        # the resolution of these classes walks the database, keep their result
+        if class_name in CACHED_CHECK_CALCULATION_CLASSES and instance.pk is not None:
+            key = (class_name, instance.pk)
+            match = check_calculation_cache.get(key)
+            if match is None:
+                match = cls._check_calculation(instance)
+                check_calculation_cache.set(key, match)
+            return match
+        return cls._check_calculation(instance)
+
+    @classmethod
+    def _check_calculation(cls, instance):
         class_name = instance.__class__.__name__
         match = False
         if class_name == "ABCMeta":
@@ -76,67 +128,125 @@ class ThirdPartyPaymentCalculationRule(AbsStrategy):
         elif class_name == "BatchRun":
             # BatchRun → Product or Location if no prodcut
             match = cls.check_calculation(instance.location)
-        elif class_name == "HealthFacility":
-            #  HF → location
-            match = cls.check_calculation(instance.location)
-        elif class_name == "Location":
-            #  location → ProductS (Product also related to Region if the location is a district)
-            if instance.type in ["D", "R"]:
-                products = Product.objects.filter(
-                    location=instance, validity_to__isnull=True
-                )
-                for product in products:
-                    if cls.check_calculation(product):
-                        match = True
-                        break
-        elif class_name == "Claim":
-            #  claim → claim product
-            products = cls.__get_products_from_claim(claim=instance)
-            # take the MAX Product id from item and services
-            if len(products) > 0:
-                product = max(products, key=operator.attrgetter("id"))
-                match = cls.check_calculation(product)
+        elif class_name in ["HealthFacility", "Location", "Claim"]:
+            match = cls.check_calculation_many(
+                [instance.pk], model=instance.__class__
+            ).get(instance.pk, False)
         elif class_name == "Product":
             # if product → paymentPlans
-            payment_plans = PaymentPlan.objects.filter(
-                benefit_plan=instance, is_deleted=False
-            )
-            for pp in payment_plans:
-                if cls.check_calculation(pp):
-                    match = True
-                    break
+            match = instance.id in cls._get_calculation_product_ids()
         return match
 
+    @classmethod
+    def check_calculation_many(cls, instances, model=None):
+        """
+        check_calculation for a queryset of Claims, Locations or HealthFacilities
+        (or a list of ids of the given model), return a {pk: bool} dict
+        the matching is done in the database with two queries whatever the number of instances
+        """
+        if model is None:
+            model = instances.model
+            queryset = instances
+        else:
+            queryset = model.objects.filter(pk__in=instances)
+        class_name = model.__name__
+        # products having a payment plan with this calculation rule
+        product_ids = cls._get_calculation_product_ids()
+        if class_name == "Claim":
+            #  claim → claim product: the MAX Product id from valid items and services
+            result = {}
+            claim_products = annotate_claim_product(queryset).values_list(
+                "id", "validity_to", "item_product_id", "service_product_id"
+            )
+            for claim_id, validity_to, *detail_product_ids in claim_products:
+                product_id = max(
+                    (p for p in detail_product_ids if p is not None), default=None
+                )
+                result[claim_id] = validity_to is None and product_id in product_ids
+            return result
+        elif class_name in ["HealthFacility", "Location"]:
+            #  HF → location → ProductS (Product also related to Region if the location is a district)
+            prefix = "location__" if class_name == "HealthFacility" else ""
+            locations = queryset.annotate(
+                has_product=Exists(
+                    Product.objects.filter(
+                        location=OuterRef(f"{prefix}id"),
+                        validity_to__isnull=True,
+                        id__in=product_ids,
+                    )
+                )
+            ).values_list("id", f"{prefix}type", "has_product")
+            return {
+                location_id: location_type in ["D", "R"] and has_product
+                for location_id, location_type, has_product in locations
+            }
+        raise ValueError(_("check_calculation_many does not support %s") % class_name)
+
+    @classmethod
+    def _get_calculation_product_ids(cls):
+        # benefit_plan is a generic foreign key, only the products are kept
+        benefit_plan_ids = PaymentPlan.objects.filter(
+            calculation=UUID(str(cls.uuid)),
+            benefit_plan_type=product_content_type(),
+            is_deleted=False,
+        ).values_list("benefit_plan_id", flat=True)
+        return {
+            int(benefit_plan_id)
+            for benefit_plan_id in benefit_plan_ids
+            if benefit_plan_id is not None
+        }
+
     @classmethod
     def calculate(cls, instance, **kwargs):
         context = kwargs.get("context", None)
         if instance.__class__.__name__ == "PaymentPlan":
             if context == "BatchPayment":
-                cls.convert_batch(instance, **kwargs)
-                return "conversion finished 'fee for service'"
+                if CalcruleThirdPartyPaymentConfig.background_conversion:
+                    job = cls.schedule_conversion_job(instance, **kwargs)
+                    return f"conversion scheduled 'fee for service' (job {job.id})"
+                if cls._converts_after_commit():
+                    # run in-process as a job, once the batch run is committed
+                    job = cls.schedule_conversion_job(
+                        instance, executor=EXECUTOR_INLINE, **kwargs
+                    )
+                    return f"conversion scheduled 'fee for service' (job {job.id})"
+                with profile_calculation(
+                    context, instance, kwargs.get("work_data")
+                ), record_calculation(f"{context} {instance.code}") as recorder:
+                    with release_staged_claims(kwargs.get("work_data")):
+                        cls.convert_batch(instance, **kwargs)
+                return cls._calculation_result(
+                    "conversion finished 'fee for service'", recorder
+                )
             elif context == "BatchValuate":
-                cls._process_batch_valuation(instance, **kwargs)
-                return "valuation finished 'fee for service'"
+                with profile_calculation(
+                    context, instance, kwargs.get("work_data")
+                ), record_calculation(f"{context} {instance.code}") as recorder:
+                    with release_staged_claims(kwargs.get("work_data")):
+                        cls._process_batch_valuation(instance, **kwargs)
+                return cls._calculation_result(
+                    "valuation finished 'fee for service'", recorder
+                )
             elif context == "IndividualPayment":
                 pass
             elif context == "IndividualValuation":
                 pass
 
+    @classmethod
+    def _calculation_result(cls, message, recorder):
+        # the recorded phases are returned along the message when the instrumentation is enabled
+        if recorder is None:
+            return message
+        return {"message": message, "instrumentation": recorder.as_dict()}
+
     @classmethod
     def get_linked_class(cls, sender, class_name, **kwargs):
         list_class = []
         if class_name is not None:
-            model_class = ContentType.objects.filter(model__iexact=class_name).first()
-            if model_class:
-                model_class = model_class.model_class()
-                list_class = list_class + [
-                    f.remote_field.model.__name__
-                    for f in model_class._meta.fields
-                    if (
-                        f.get_internal_type() == "ForeignKey"
-                        and f.remote_field.model.__name__ != "User"
-                    )
-                ]
+            # precomputed ForeignKey targets of the model, no database access
+            list_class = list_class + list(
+                get_linked_class_map().get(class_name.lower(), ())
+            )
         else:
             list_class.append("Calculation")
         # because we have calculation in PaymentPlan
@@ -148,103 +258,563 @@ class ThirdPartyPaymentCalculationRule(AbsStrategy):
     @classmethod
     def convert(cls, instance, convert_to, **kwargs):
         results = {}
-        if check_bill_exist(instance, convert_to):
-            convert_from = instance.__class__.__name__
-            if convert_from == "QuerySet":
-                # get the model name from queryset
-                convert_from = instance.model.__name__
-                if convert_from == "Claim":
-                    results = cls._convert_claims(instance, **kwargs)
-            results["user"] = kwargs.get("user", None)
-            BillService.bill_create(convert_results=results)
+        convert_from = instance.__class__.__name__
+        if convert_from == "QuerySet":
+            # get the model name from queryset
+            convert_from = instance.model.__name__
+            if convert_from == "Claim":
+                results = cls._convert_claims(instance, **kwargs)
+        cls._create_bill(results, kwargs.get("user", None))
         return results
 
+    @classmethod
+    def _create_bill(cls, results, user):
+        # nothing to bill (e.g. all the claims are already billed)
+        if results:
+            # BillService expects the line items as dicts
+            results = {
+                **results,
+                "bill_data_line": to_bill_data_lines(results["bill_data_line"]),
+                "user": user,
+            }
+            BillService.bill_create(convert_results=results)
+            add_rows(1)
+
     @classmethod
     def convert_batch(cls, instance, work_data=None, **kwargs):
-        pp_params = obtain_calcrule_params(
-            instance, INTEGER_PARAMETERS, NONE_INTEGER_PARAMETERS
-        )
-        work_data = cls.filter_work_data(work_data, pp_params)
+        compiled_payment_plan = get_compiled_payment_plan(instance)
+        with phase("filter_work_data"):
+            work_data = cls.filter_work_data(work_data, compiled_payment_plan)
         logger.debug(f"creating bill for br {work_data['created_run']}")
         if work_data:
+            with phase("product_resolution"):
+                user = User.objects.filter(
+                    i_user__id=work_data["created_run"].audit_user_id
+                ).first()
+                # create queryset based on provided params
+                claim_queryset = work_data["claims"]
+                # claims already billed (e.g. re-run after a partial failure) are skipped
+                billed_claim_ids = get_billed_claim_ids(claim_queryset)
+                health_facility_products = get_health_facility_products(claim_queryset)
+                # per health facility totals, known before any per claim work
+                health_facility_totals = get_health_facility_bill_totals(claim_queryset)
+                claim_br_hf_list = list(
+                    HealthFacility.objects.filter(
+                        id__in=Subquery(
+                            claim_queryset.values_list(
+                                "health_facility", flat=True
+                            ).distinct()
+                        )
+                    ).order_by("id")
+                )
+            if CalcruleThirdPartyPaymentConfig.per_facility_commit:
+                # bills and claims of each health facility committed together,
+                # see _converts_after_commit for the batch runs in a transaction
+                if connection.in_atomic_block:
+                    logger.warning(
+                        "per_facility_commit: the batch run is in a transaction, "
+                        "the health facilities are only committed with it"
+                    )
+                with phase("bill_persistence"):
+                    for health_facility in claim_br_hf_list:
+                        cls._commit_health_facility(
+                            claim_queryset.filter(health_facility=health_facility),
+                            user,
+                            bulk=CalcruleThirdPartyPaymentConfig.bulk_bill_creation,
+                            health_facility=health_facility,
+                            work_data=work_data,
+                            billed_claim_ids=billed_claim_ids,
+                            health_facility_products=health_facility_products,
+                            health_facility_totals=health_facility_totals,
+                            **kwargs,
+                        )
+                return
+            # take all claims related to the same HF and batch_run to convert to bill
+            converted_bills = cls._convert_health_facilities(
+                claim_queryset,
+                claim_br_hf_list,
+                work_data=work_data,
+                billed_claim_ids=billed_claim_ids,
+                health_facility_products=health_facility_products,
+                health_facility_totals=health_facility_totals,
+                **kwargs,
+            )
+            # the conversion of each health facility runs (lazily) during the persistence
+            with phase("bill_persistence"):
+                if CalcruleThirdPartyPaymentConfig.streaming_conversion:
+                    for results in converted_bills:
+                        if results:
+                            bills = create_bill_streaming(
+                                results,
+                                user,
+                                CalcruleThirdPartyPaymentConfig.streaming_chunk_size,
+                                CalcruleThirdPartyPaymentConfig.bill_max_lines,
+                                CalcruleThirdPartyPaymentConfig.bill_max_amount,
+                            )
+                            add_rows(len(bills))
+                elif CalcruleThirdPartyPaymentConfig.bulk_bill_creation:
+                    cls._create_bills_bulk(converted_bills, user)
+                else:
+                    for results in converted_bills:
+                        cls._create_bill(results, user)
+            with phase("claim_updates"):
+                update_claim_indexed_remunerated(
+                    claim_queryset,
+                    work_data["created_run"],
+                )
+
+    @classmethod
+    def _converts_after_commit(cls):
+        # in a transaction (e.g. process_batch) the health facilities can't be committed
+        # one by one and the parallel workers, reading on their own connection, don't
+        # see the claims valuated by the batch run: it is converted once committed
+        if not connection.in_atomic_block:
+            return False
+        return CalcruleThirdPartyPaymentConfig.per_facility_commit or (
+            CalcruleThirdPartyPaymentConfig.parallel_conversion
+            and not CalcruleThirdPartyPaymentConfig.streaming_conversion
+        )
+
+    @classmethod
+    def schedule_conversion_job(cls, instance, work_data=None, executor=None, **kwargs):
+        """
+        record a ConversionJob for the batch run and payment plan (instance) and run it
+        in the background once the batch run is committed, see run_conversion_job
+        (executor: see jobs.submit_conversion_job)
+        """
+        job, created = ConversionJob.objects.get_or_create(
+            batch_run_id=work_data["created_run"].id,
+            payment_plan_id=instance.id,
+            defaults={
+                "product_id": work_data["product"].id,
+                "start_date": work_data["start_date"],
+                "end_date": work_data["end_date"],
+            },
+        )
+        if job.status in ConversionJob.RUNNABLE_STATUSES:
+            submit_conversion_job(job, cls.run_conversion_job, executor)
+        return job
+
+    @classmethod
+    def resume_conversion_job(cls, job):
+        """
+        run again a failed job, the health facilities already done are skipped (a job
+        interrupted while running must be set back to failed first)
+        """
+        if job.status in ConversionJob.RUNNABLE_STATUSES:
+            submit_conversion_job(job, cls.run_conversion_job)
+        return job
+
+    @classmethod
+    def run_conversion_job(cls, job_id):
+        # the job is claimed by a single run, a job already running or done is skipped
+        claimed = ConversionJob.objects.filter(
+            id=job_id, status__in=ConversionJob.RUNNABLE_STATUSES
+        ).update(
+            status=ConversionJob.STATUS_RUNNING,
+            date_started=py_datetime.now(),
+            date_finished=None,
+            error=None,
+        )
+        if not claimed:
+            logger.info(f"conversion job {job_id} is running or done, skipped")
+            return
+        job = ConversionJob.objects.get(id=job_id)
+        try:
+            payment_plan = PaymentPlan.objects.get(id=job.payment_plan_id)
+            product = Product.objects.get(id=job.product_id)
+            # the work data of the BatchPayment context, rebuilt from the job
+            # so that the job can be resumed in another process
+            work_data = {
+                "created_run": BatchRun.objects.get(id=job.batch_run_id),
+                "product": product,
+                "end_date": job.end_date,
+            }
+            # the allocated contributions are not used by the conversion
+            # (not unpacked to "_", the gettext alias of this module)
+            work_data = update_work_data(
+                work_data,
+                product,
+                Claim.STATUS_VALUATED,
+                job.start_date,
+                job.end_date,
+            )[1]
+            with profile_calculation(
+                "BatchPayment", payment_plan, work_data
+            ), record_calculation(f"BatchPayment {payment_plan.code}"):
+                # the staged claim ids of a failed job are deleted too
+                with release_staged_claims(work_data):
+                    failed = cls.convert_batch_resumable(payment_plan, job, work_data)
+        except Exception as exc:
+            logger.exception(f"conversion job {job.id} failed")
+            job.status = ConversionJob.STATUS_FAILED
+            job.error = str(exc)
+        else:
+            if failed:
+                job.status = ConversionJob.STATUS_FAILED
+                job.error = (
+                    _("bill conversion failed for %s health facilities") % failed
+                )
+            else:
+                job.status = ConversionJob.STATUS_DONE
+        job.date_finished = py_datetime.now()
+        job.save()
+
+    @classmethod
+    def convert_batch_resumable(cls, instance, job, work_data):
+        """
+        convert_batch committing each health facility (see _commit_health_facility)
+        with its checkpoint, the health facilities already done by the job are skipped.
+        Return the number of failed health facilities
+        """
+        compiled_payment_plan = get_compiled_payment_plan(instance)
+        with phase("filter_work_data"):
+            work_data = cls.filter_work_data(work_data, compiled_payment_plan)
+        with phase("product_resolution"):
             user = User.objects.filter(
                 i_user__id=work_data["created_run"].audit_user_id
             ).first()
-            # create queryset based on provided params
             claim_queryset = work_data["claims"]
-            claim_br_hf_list = HealthFacility.objects.filter(
-                id__in=Subquery(
-                    claim_queryset.values_list("health_facility", flat=True).distinct()
+            billed_claim_ids = get_billed_claim_ids(claim_queryset)
+            health_facility_products = get_health_facility_products(claim_queryset)
+            health_facility_totals = get_health_facility_bill_totals(claim_queryset)
+            health_facilities = list(
+                HealthFacility.objects.filter(
+                    id__in=Subquery(
+                        claim_queryset.values_list(
+                            "health_facility", flat=True
+                        ).distinct()
+                    )
+                ).order_by("id")
+            )
+        done_health_facility_ids = set(
+            job.checkpoints.filter(status=ConversionCheckpoint.STATUS_DONE).values_list(
+                "health_facility_id", flat=True
+            )
+        )
+        job.total = len(health_facilities)
+        job.save(update_fields=["total"])
+        health_facilities = [
+            health_facility
+            for health_facility in health_facilities
+            if health_facility.id not in done_health_facility_ids
+        ]
+        conversion_kwargs = {
+            "work_data": work_data,
+            "billed_claim_ids": billed_claim_ids,
+            "health_facility_products": health_facility_products,
+            "health_facility_totals": health_facility_totals,
+        }
+        failed = 0
+        # the batch run is committed, the parallel workers see its valuated claims
+        with (
+            ThreadPoolExecutor(
+                max_workers=CalcruleThirdPartyPaymentConfig.parallel_conversion_workers
+            )
+            if CalcruleThirdPartyPaymentConfig.parallel_conversion
+            else nullcontext()
+        ) as executor:
+            conversions = [
+                (
+                    executor.submit(
+                        cls._convert_in_worker,
+                        claim_queryset.filter(health_facility=health_facility),
+                        health_facility=health_facility,
+                        **conversion_kwargs,
+                    )
+                    if executor is not None
+                    else None
+                )
+                for health_facility in health_facilities
+            ]
+            # the health facilities are committed one after the other, in their order
+            for health_facility, conversion in zip(health_facilities, conversions):
+                try:
+                    with phase("bill_persistence"), transaction.atomic():
+                        bills = cls._commit_health_facility(
+                            claim_queryset.filter(health_facility=health_facility),
+                            user,
+                            bulk=True,
+                            conversion=conversion,
+                            health_facility=health_facility,
+                            **conversion_kwargs,
+                        )
+                        ConversionCheckpoint.objects.update_or_create(
+                            job=job,
+                            health_facility_id=health_facility.id,
+                            defaults={
+                                "status": ConversionCheckpoint.STATUS_DONE,
+                                "bill_id": bills[0].id if bills else None,
+                                "bill_count": len(bills),
+                                "error": None,
+                                "date_updated": py_datetime.now(),
+                            },
+                        )
+                except Exception as exc:
+                    logger.exception(
+                        f"bill conversion failed for health facility {health_facility.code}"
+                    )
+                    failed += 1
+                    ConversionCheckpoint.objects.update_or_create(
+                        job=job,
+                        health_facility_id=health_facility.id,
+                        defaults={
+                            "status": ConversionCheckpoint.STATUS_FAILED,
+                            "bill_id": None,
+                            "bill_count": 0,
+                            "error": str(exc),
+                            "date_updated": py_datetime.now(),
+                        },
+                    )
+        return failed
+
+    @classmethod
+    def _commit_health_facility(
+        cls, claim_queryset, user, bulk=False, conversion=None, **kwargs
+    ):
+        """
+        save the bills of the claims of a health facility and update their remunerated
+        amounts in one transaction (a savepoint if already in a transaction), return
+        the saved bills (only known when saved with bulk inserts).
+        conversion is the future of the conversion run by a parallel worker, if any
+        """
+        if conversion is not None:
+            results = conversion.result()
+        else:
+            results = cls._convert_claims(claim_queryset, **kwargs)
+        with transaction.atomic():
+            results_list = [
+                results for results in cls._split_convert_results(results) if results
+            ]
+            bills = []
+            if bulk and results_list:
+                bills = bulk_create_bills(
+                    results_list,
+                    user,
+                    batch_size=CalcruleThirdPartyPaymentConfig.bulk_bill_creation_batch_size,
                 )
+            else:
+                for results in results_list:
+                    cls._create_bill(results, user)
+            cls._update_claim_remunerated(
+                claim_queryset, kwargs["work_data"]["created_run"]
+            )
+        return bills
+
+    @classmethod
+    def _update_claim_remunerated(cls, claim_queryset, batch_run):
+        # by primary key range chunks, so that the lock duration depends on the chunk size
+        for chunk in iter_pk_range_chunks(
+            claim_queryset,
+            CalcruleThirdPartyPaymentConfig.remuneration_update_chunk_size,
+        ):
+            update_claim_indexed_remunerated(chunk, batch_run)
+
+    @classmethod
+    def _convert_health_facilities(cls, claim_queryset, health_facilities, **kwargs):
+        """
+        yield the conversion results of each health facility (or of each part of its bill,
+        see _split_convert_results), in the health facility order
+        """
+        if CalcruleThirdPartyPaymentConfig.streaming_conversion:
+            # the line items are built (lazily) while the bill is saved
+            kwargs["streaming_chunk_size"] = (
+                CalcruleThirdPartyPaymentConfig.streaming_chunk_size
             )
-            for cbh in claim_br_hf_list:
-                claim_queryset_by_br_hf = claim_queryset.filter(health_facility=cbh)
-                # take all claims related to the same HF and batch_run to convert to bill
-                cls.run_convert(
-                    instance=claim_queryset_by_br_hf,
-                    convert_to="Bill",
-                    user=user,
-                    health_facility=cbh,
-                    work_data=work_data,
+            for health_facility in health_facilities:
+                yield cls._convert_claims(
+                    claim_queryset.filter(health_facility=health_facility),
+                    health_facility=health_facility,
                     **kwargs,
                 )
-            update_claim_indexed_remunerated(
-                claim_queryset,
-                work_data["created_run"],
+        elif (
+            CalcruleThirdPartyPaymentConfig.parallel_conversion
+            and cls._can_convert_in_parallel()
+        ):
+            for results in cls._convert_parallel(
+                claim_queryset, health_facilities, **kwargs
+            ):
+                yield from cls._split_convert_results(results)
+        else:
+            for health_facility in health_facilities:
+                yield from cls._split_convert_results(
+                    cls._convert_claims(
+                        claim_queryset.filter(health_facility=health_facility),
+                        health_facility=health_facility,
+                        **kwargs,
+                    )
+                )
+
+    @classmethod
+    def _can_convert_in_parallel(cls):
+        # the workers read on their own connection: they would not see the claims
+        # valuated in the transaction of the batch run (e.g. process_batch)
+        if connection.in_atomic_block:
+            logger.warning(
+                "parallel_conversion ignored, the batch run is in a transaction: "
+                "the health facilities are converted one after the other"
+            )
+            return False
+        return True
+
+    @classmethod
+    def _split_convert_results(cls, results):
+        # one conversion results per bill when the bill is over the max lines/amount
+        max_lines = CalcruleThirdPartyPaymentConfig.bill_max_lines
+        max_amount = CalcruleThirdPartyPaymentConfig.bill_max_amount
+        if not results or not (max_lines or max_amount):
+            return [results]
+        return [
+            {**results, "bill_data": bill, "bill_data_line": bill_line_items}
+            for bill, bill_line_items in ClaimsToBillConverter.split_bill(
+                results["bill_data"], results["bill_data_line"], max_lines, max_amount
+            )
+        ]
+
+    @classmethod
+    def _convert_parallel(cls, claim_queryset, health_facilities, **kwargs):
+        """
+        convert the claims of each health facility in a thread pool,
+        the results are yielded in the health facility order
+        and an exception listing all the failed health facilities
+        is raised once every conversion is done
+        """
+        health_facilities = list(health_facilities)
+        errors = []
+        with ThreadPoolExecutor(
+            max_workers=CalcruleThirdPartyPaymentConfig.parallel_conversion_workers
+        ) as executor:
+            futures = [
+                executor.submit(
+                    cls._convert_in_worker,
+                    claim_queryset.filter(health_facility=health_facility),
+                    health_facility=health_facility,
+                    **kwargs,
+                )
+                for health_facility in health_facilities
+            ]
+            for health_facility, future in zip(health_facilities, futures):
+                try:
+                    results = future.result()
+                except Exception as exc:
+                    logger.exception(
+                        f"bill conversion failed for health facility {health_facility.code}"
+                    )
+                    errors.append(f"{health_facility.code}: {exc}")
+                else:
+                    yield results
+        if errors:
+            raise Exception(
+                _("bill conversion failed for %s health facilities: %s")
+                % (len(errors), "; ".join(errors))
             )
 
+    @classmethod
+    def _create_bills_bulk(cls, converted_bills, user):
+        # save the bills by chunk of health facilities, each chunk in one transaction
+        chunk_size = CalcruleThirdPartyPaymentConfig.bulk_bill_creation_chunk_size
+        batch_size = CalcruleThirdPartyPaymentConfig.bulk_bill_creation_batch_size
+        chunk = []
+        for results in converted_bills:
+            if results:
+                chunk.append(results)
+            if chunk_size and len(chunk) >= chunk_size:
+                bulk_create_bills(chunk, user, batch_size=batch_size)
+                add_rows(len(chunk))
+                chunk = []
+        if chunk:
+            bulk_create_bills(chunk, user, batch_size=batch_size)
+            add_rows(len(chunk))
+
+    @classmethod
+    def _convert_in_worker(cls, instance, **kwargs):
+        # each worker thread opens its own database connection, close it when done
+        try:
+            return cls._convert_claims(instance, **kwargs)
+        finally:
+            connections.close_all()
+
     @classmethod
     def _process_batch_valuation(cls, instance, work_data=None, **kwargs):
-        pp_params = obtain_calcrule_params(
-            instance, INTEGER_PARAMETERS, NONE_INTEGER_PARAMETERS
-        )
-        work_data["pp_params"] = pp_params
+        compiled_payment_plan = get_compiled_payment_plan(instance)
+        work_data["pp_params"] = dict(compiled_payment_plan.params)
         # manage the in/out patient params
-        work_data = cls.filter_work_data(work_data, pp_params)
+        with phase("filter_work_data"):
+            work_data = cls.filter_work_data(work_data, compiled_payment_plan)
         claim_batch_valuation(instance, work_data)
-        update_claim_valuated(work_data["claims"], work_data["created_run"])
+        with phase("claim_updates"):
+            update_claim_valuated(work_data["claims"], work_data["created_run"])
+
+    @classmethod
+    def simulate_valuation(cls, instance, periods, candidates, audit_user_id=-1):
+        """
+        what-if BatchValuate of the payment plan (instance) for each period (start date,
+        end date) and candidate parameters, nothing is saved (see simulate_claim_batch_valuation)
+        """
+        return simulate_claim_batch_valuation(
+            instance, periods, candidates, audit_user_id
+        )
 
     @staticmethod
-    def filter_work_data(work_data, pp_params):
+    def filter_work_data(work_data, compiled_payment_plan):
         product = work_data.get("product")
-        work_data["claims"] = (
-            work_data["claims"]
-            .filter(get_hospital_level_filter(pp_params))
-            .filter(
-                get_hospital_claim_filter(
-                    product.ceiling_interpretation, pp_params["claim_type"]
-                )
-            )
-        )
-        work_data["items"] = (
-            work_data["items"]
-            .filter(get_hospital_level_filter(pp_params, prefix="claim__"))
-            .filter(
-                get_hospital_claim_filter(
-                    product.ceiling_interpretation, pp_params["claim_type"], "claim__"
-                )
-            )
+        ceiling_interpretation = product.ceiling_interpretation
+        claims = work_data["claims"].filter(
+            compiled_payment_plan.get_filter(ceiling_interpretation)
         )
-        work_data["services"] = (
-            work_data["services"]
-            .filter(get_hospital_level_filter(pp_params, prefix="claim__"))
-            .filter(
-                get_hospital_claim_filter(
-                    product.ceiling_interpretation, pp_params["claim_type"], "claim__"
+        # the eligible claims are resolved once, the items, services and later
+        # statements then filter on their ids instead of joining the claims again:
+        # as a list of ids for the small batch runs, staged in the StagedClaim table
+        # for the larger ones (see release_staged_claims)
+        max_size = CalcruleThirdPartyPaymentConfig.materialized_claim_ids_max_size
+        claim_ids = materialize_claim_ids(claims, max_size)
+        if claim_ids is not None:
+            work_data["claims"] = claims.model.objects.filter(id__in=claim_ids)
+            eligible_claims = Q(claim_id__in=claim_ids)
+        elif max_size:
+            work_data["claim_stage_id"] = stage_claim_ids(claims)
+            staged_claim_ids = Subquery(
+                StagedClaim.objects.filter(stage_id=work_data["claim_stage_id"]).values(
+                    "claim_id"
                 )
             )
-        )
+            work_data["claims"] = claims.model.objects.filter(id__in=staged_claim_ids)
+            eligible_claims = Q(claim_id__in=staged_claim_ids)
+        else:
+            work_data["claims"] = claims
+            eligible_claims = Q(claim_id__in=Subquery(claims.values("id")))
+        work_data["items"] = work_data["items"].filter(eligible_claims)
+        work_data["services"] = work_data["services"].filter(eligible_claims)
 
         return work_data
 
     @classmethod
     def _convert_claims(cls, instance, **kwargs):
-        products = cls.__get_products_from_claim_queryset(claim_queryset=instance)
-        # take the MAX Product id from item and services
-        if len(products) > 0:
-            product = max(products, key=operator.attrgetter("id"))
+        with phase("line_building"):
+            return cls.__convert_claims(instance, **kwargs)
+
+    @classmethod
+    def __convert_claims(cls, instance, **kwargs):
+        health_facility = kwargs.get("health_facility")
+        # product resolved for the whole batch run, see get_health_facility_products
+        health_facility_products = kwargs.get("health_facility_products")
+        if health_facility_products is not None:
+            product = health_facility_products.get(health_facility.id)
+        else:
+            product = cls._get_product_from_claim_queryset(claim_queryset=instance)
+        # totals of the batch run, see get_health_facility_bill_totals
+        health_facility_totals = kwargs.get("health_facility_totals")
+        totals = None
+        if health_facility_totals is not None:
+            totals = health_facility_totals.get(health_facility.id)
+            # no claim left to bill, skip the per claim work
+            if not totals:
+                return None
+        if product is not None:
             work_data = kwargs.get("work_data")
-            health_facility = kwargs.get("health_facility")
+            billed_claim_ids = kwargs.get("billed_claim_ids")
+            if billed_claim_ids is None:
+                billed_claim_ids = get_billed_claim_ids(instance)
             if work_data:
                 batch_run = work_data.get("created_run")
 
@@ -254,13 +824,28 @@ class ThirdPartyPaymentCalculationRule(AbsStrategy):
                     health_facility=health_facility,
                     batch_run=batch_run,
                 )
-                bill_line_items = []
-                for claim in instance.all():
-                    bill_line_item = ClaimToBillItemConverter.to_bill_line_item_obj(
-                        claim=claim
+                if billed_claim_ids and has_billed_claims(instance):
+                    # partly billed health facility, suffix the code of its new bill
+                    ClaimsToBillConverter.build_rerun_code(
+                        bill, get_next_rerun_number(bill["code"])
                     )
-                    bill_line_items.append(bill_line_item)
-                    ClaimsToBillConverter.build_amounts(bill_line_item, bill)
+                if totals:
+                    # the header amounts are known before building the line items
+                    ClaimsToBillConverter.build_amounts_from_totals(totals, bill)
+                streaming_chunk_size = kwargs.get("streaming_chunk_size")
+                bill_line_items = cls._iter_bill_line_items(
+                    instance,
+                    bill,
+                    billed_claim_ids,
+                    streaming_chunk_size,
+                    add_amounts=not totals,
+                )
+                # when streaming, the line items are built while being saved
+                if not streaming_chunk_size:
+                    bill_line_items = list(bill_line_items)
+                    add_rows(len(bill_line_items))
+                    if not bill_line_items:
+                        return None
             else:
                 raise Exception(
                     _(
@@ -276,23 +861,46 @@ class ThirdPartyPaymentCalculationRule(AbsStrategy):
             }
 
     @classmethod
-    def __get_products_from_claim_queryset(cls, claim_queryset):
-        return Product.objects.filter(
-            Q(id__in=Subquery(claim_queryset.values("items__product")))
-            | Q(id__in=Subquery(claim_queryset.values("services__product")))
-        )
+    def _iter_bill_line_items(
+        cls, claims, bill, billed_claim_ids, chunk_size=None, add_amounts=True
+    ):
+        """
+        yield the bill line items of the claims (not yet billed) and add their amounts to the bill
+        (unless add_amounts is False, the bill amounts being then already set),
+        with a chunk_size the claims and their details are read by primary key range chunks
+        so that the memory used does not depend on the number of claims
+        """
+        if chunk_size:
+            claim_chunks = iter_pk_range_chunks(claims, chunk_size)
+        else:
+            claim_chunks = [claims]
+        for claim_chunk in claim_chunks:
+            claim_rows = list(
+                claim_chunk.values(*ClaimToBillItemConverter.CLAIM_FIELDS)
+            )
+            # details of all the claims of the chunk (or health facility) at once
+            # (the chunk as a primary key range subquery, not a list of ids)
+            claim_details = ClaimToBillItemConverter.build_claim_details_map(
+                claims=claim_chunk
+            )
+            for claim in claim_rows:
+                if claim["id"] in billed_claim_ids:
+                    continue
+                bill_line_item = ClaimToBillItemConverter.to_bill_line_item_obj(
+                    claim=claim, claim_details=claim_details
+                )
+                if add_amounts:
+                    ClaimsToBillConverter.build_amounts(bill_line_item, bill)
+                yield bill_line_item
 
     @classmethod
-    def __get_products_from_claim(cls, claim):
-        products = []
-        # get the clam product from claim item and claim services
-        for svc_item in [ClaimItem, ClaimService]:
-            claim_details = (
-                svc_item.objects.filter(claim__id=claim.id)
-                .filter(claim__validity_to__isnull=True)
-                .filter(validity_to__isnull=True)
+    def _get_product_from_claim_queryset(cls, claim_queryset):
+        # take the MAX Product id from item and services
+        return (
+            Product.objects.filter(
+                Q(id__in=Subquery(claim_queryset.values("items__product")))
+                | Q(id__in=Subquery(claim_queryset.values("services__product")))
             )
-            for cd in claim_details:
-                if cd.product:
-                    products.append(cd.product)
-        return products
+            .order_by("-id")
+            .first()
+        )
@@ -1,7 +1,9 @@
+from calcrule_third_party_payment.converters.bill_line_item import BillLineItem
 from calcrule_third_party_payment.converters.claim_to_bill_item import (
     ClaimToBillItemConverter,
 )
 from calcrule_third_party_payment.converters.claims_to_bill import ClaimsToBillConverter
 
+BillLineItem = BillLineItem
 ClaimToBillItemConverter = ClaimToBillItemConverter
 ClaimsToBillConverter = ClaimsToBillConverter
@@ -0,0 +1,97 @@
+CLAIM_DETAIL_FIELDS = (
+    "name",
+    "quantity",
+    "quantity_approved",
+    "price",
+    "price_approved",
+)
+
+
+class BillLineItem(object):
+    """
+    bill line item built by ClaimToBillItemConverter, a slotted record instead of a dict
+    (the claim details are kept as raw tuples, see CLAIM_DETAIL_FIELDS).
+    to_dict gives the bill_data_line shape expected by BillService.bill_create and
+    apply_to sets the fields on a BillItem instance (bulk inserts)
+    """
+
+    __slots__ = (
+        "line_id",
+        "line_type",
+        "date_valid_from",
+        "date_valid_to",
+        "code",
+        "description",
+        "details",
+        "quantity",
+        "unit_price",
+        "deduction",
+        "amount_net",
+        "amount_total",
+    )
+    # left out of the dict (or the BillItem) when not set
+    OPTIONAL_FIELDS = ("deduction",)
+
+    def __init__(self):
+        for field in self.__slots__:
+            setattr(self, field, None)
+
+    # dict like access, for the code written for the dict line items
+    def __getitem__(self, field):
+        if field not in self:
+            raise KeyError(field)
+        return getattr(self, field)
+
+    def __setitem__(self, field, value):
+        setattr(self, field, value)
+
+    def __contains__(self, field):
+        return field in self.__slots__ and (
+            field not in self.OPTIONAL_FIELDS or getattr(self, field) is not None
+        )
+
+    def get_details(self):
+        if self.details is None:
+            return None
+        return {"claim_details": format_claim_details(self.details)}
+
+    def to_dict(self):
+        bill_line_item = {}
+        for field in self.__slots__:
+            if field in self:
+                bill_line_item[field] = getattr(self, field)
+        bill_line_item["details"] = self.get_details()
+        return bill_line_item
+
+    def apply_to(self, bill_item):
+        for field in self.__slots__:
+            if field in self:
+                setattr(bill_item, field, getattr(self, field))
+        bill_item.details = self.get_details()
+        return bill_item
+
+
+def format_claim_details(claim_details):
+    # the claim item/service values are saved as strings in the bill item details
+    return [
+        {
+            "name": name,
+            "quantity": f"{quantity}",
+            "quantity_approved": f"{quantity_approved}",
+            "price": f"{price}",
+            "price_approved": f"{price_approved}",
+        }
+        for name, quantity, quantity_approved, price, price_approved in claim_details
+    ]
+
+
+def to_bill_data_lines(bill_line_items):
+    """the bill line items as the list of dicts expected by BillService.bill_create"""
+    return [
+        (
+            bill_line_item.to_dict()
+            if isinstance(bill_line_item, BillLineItem)
+            else bill_line_item
+        )
+        for bill_line_item in bill_line_items
+    ]
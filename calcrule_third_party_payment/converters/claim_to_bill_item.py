@@ -1,18 +1,31 @@
 from django.contrib.contenttypes.models import ContentType
 
-from claim.models import ClaimItem, ClaimService
+from calcrule_third_party_payment.converters.bill_line_item import BillLineItem
+from claim.models import Claim, ClaimItem, ClaimService
 
 
 class ClaimToBillItemConverter(object):
+    # narrow projection of the claim used to build the bill line item,
+    # the claims are consumed as plain rows (dict) instead of model instances
+    CLAIM_FIELDS = (
+        "id",
+        "code",
+        "date_from",
+        "date_to",
+        "claimed",
+        "remunerated",
+        "icd__code",
+        "icd__name",
+    )
 
     @classmethod
-    def to_bill_line_item_obj(cls, claim):
-        bill_line_item = {}
+    def to_bill_line_item_obj(cls, claim, claim_details=None):
+        bill_line_item = BillLineItem()
         cls.build_line_fk(bill_line_item, claim)
         cls.build_dates(bill_line_item, claim)
         cls.build_code(bill_line_item, claim)
         cls.build_description(bill_line_item, claim)
-        cls.build_details(bill_line_item, claim)
+        cls.build_details(bill_line_item, claim, claim_details)
         cls.build_quantity(bill_line_item)
         cls.build_unit_price(bill_line_item, claim)
         cls.build_discount(bill_line_item, claim)
@@ -22,77 +35,87 @@ class ClaimToBillItemConverter(object):
 
     @classmethod
     def build_line_fk(cls, bill_line_item, claim):
-        bill_line_item["line_id"] = claim.id
-        bill_line_item["line_type"] = ContentType.objects.get_for_model(claim)
+        bill_line_item.line_id = claim["id"]
+        bill_line_item.line_type = ContentType.objects.get_for_model(Claim)
 
     @classmethod
     def build_dates(cls, bill_line_item, claim):
-        bill_line_item["date_valid_from"] = claim.date_from
-        bill_line_item["date_valid_to"] = claim.date_to
+        bill_line_item.date_valid_from = claim["date_from"]
+        bill_line_item.date_valid_to = claim["date_to"]
 
     @classmethod
     def build_code(cls, bill_line_item, claim):
-        bill_line_item["code"] = claim.code
+        bill_line_item.code = claim["code"]
 
     @classmethod
     def build_description(cls, bill_line_item, claim):
-        bill_line_item["description"] = f"{claim.icd.code} {claim.icd.name}"
+        bill_line_item.description = f"{claim['icd__code']} {claim['icd__name']}"
 
     @classmethod
-    def build_details(cls, bill_line_item, claim):
-        details = []
-        for svc_item in [ClaimItem, ClaimService]:
+    def build_details(cls, bill_line_item, claim, claim_details=None):
+        # claim_details is the claim id → details map from build_claim_details_map,
+        # if not provided the details of this claim are fetched on the fly
+        if claim_details is None:
+            claim_details = cls.build_claim_details_map(claims=[claim["id"]])
+        details = claim_details.get(claim["id"], [])
+        bill_line_item.details = details
+
+    @classmethod
+    def build_claim_details_map(cls, claims):
+        # fetch the items and services of all claims with their name at once
+        # (one query per detail type) and group them by claim id, the details
+        # are kept as tuples (see CLAIM_DETAIL_FIELDS) and formatted when saved
+        claim_details_map = {}
+        for svc_item, name_field in [
+            (ClaimItem, "item__name"),
+            (ClaimService, "service__name"),
+        ]:
             claim_details = (
-                svc_item.objects.filter(claim__id=claim.id)
+                svc_item.objects.filter(claim__in=claims)
                 .filter(claim__validity_to__isnull=True)
                 .filter(validity_to__isnull=True)
-            )
-            for claim_detail in claim_details:
-                name = (
-                    claim_detail.item.name
-                    if claim_detail.__class__.__name__ == "ClaimItem"
-                    else claim_detail.service.name
+                .values_list(
+                    "claim_id",
+                    name_field,
+                    "qty_provided",
+                    "qty_approved",
+                    "price_asked",
+                    "price_approved",
                 )
-                details.append(
-                    {
-                        "name": name,
-                        "quantity": f"{claim_detail.qty_provided}",
-                        "quantity_approved": f"{claim_detail.qty_approved}",
-                        "price": f"{claim_detail.price_asked}",
-                        "price_approved": f"{claim_detail.price_approved}",
-                    }
-                )
-        bill_line_item["details"] = {"claim_details": details}
+            )
+            for claim_id, *claim_detail in claim_details:
+                claim_details_map.setdefault(claim_id, []).append(tuple(claim_detail))
+        return claim_details_map
 
     @classmethod
     def build_quantity(cls, bill_line_item):
-        bill_line_item["quantity"] = 1
+        bill_line_item.quantity = 1
 
     @classmethod
     def build_unit_price(cls, bill_line_item, claim):
-        bill_line_item["unit_price"] = claim.claimed or claim.remunerated
+        bill_line_item.unit_price = claim["claimed"] or claim["remunerated"]
 
     @classmethod
     def build_discount(cls, bill_line_item, claim):
-        if claim.claimed and claim.remunerated:
-            if claim.claimed != claim.remunerated:
-                bill_line_item["deduction"] = claim.claimed - claim.remunerated
+        if claim["claimed"] and claim["remunerated"]:
+            if claim["claimed"] != claim["remunerated"]:
+                bill_line_item.deduction = claim["claimed"] - claim["remunerated"]
 
     @classmethod
     def build_tax(cls, bill_line_item):
-        bill_line_item["tax_rate"] = None
-        bill_line_item["tax_analysis"] = None
+        bill_line_item.tax_rate = None
+        bill_line_item.tax_analysis = None
 
     @classmethod
     def build_amounts(cls, bill_line_item):
-        if bill_line_item["unit_price"]:
-            bill_line_item["amount_net"] = (
-                bill_line_item["quantity"] * bill_line_item["unit_price"]
+        if bill_line_item.unit_price:
+            bill_line_item.amount_net = (
+                bill_line_item.quantity * bill_line_item.unit_price
             )
         else:
-            bill_line_item["amount_net"] = 0
-        if "deduction" in bill_line_item:
-            bill_line_item["amount_net"] = (
-                bill_line_item["amount_net"] - bill_line_item["deduction"]
+            bill_line_item.amount_net = 0
+        if bill_line_item.deduction is not None:
+            bill_line_item.amount_net = (
+                bill_line_item.amount_net - bill_line_item.deduction
             )
-        bill_line_item["amount_total"] = bill_line_item["amount_net"]
+        bill_line_item.amount_total = bill_line_item.amount_net
@@ -1,3 +1,5 @@
+import itertools
+
 from django.contrib.contenttypes.models import ContentType
 from django.utils.translation import gettext as _
 
@@ -58,6 +60,12 @@ class ClaimsToBillConverter(object):
             f"-{batch_run.run_date.strftime('%Y-%m')}"
         )
 
+    @classmethod
+    def build_rerun_code(cls, bill, rerun_number):
+        # claims left to bill by a previous (partial) run of the health facility,
+        # the bill of that run has the same code
+        bill["code"] = f"{bill['code']}-R{rerun_number}"
+
     @classmethod
     def build_date_dates(cls, batch_run, bill):
         from core import datetimedelta
@@ -95,6 +103,12 @@ class ClaimsToBillConverter(object):
         # bill_update["amount_deduction"] += 0 if "deduction" in  line_item or not line_item["deduction"]
         # else line_item["deduction"]
 
+    @classmethod
+    def build_amounts_from_totals(cls, totals, bill_update):
+        # totals of the health facility, see utils.get_health_facility_bill_totals
+        bill_update["amount_net"] = totals["amount_net"]
+        bill_update["amount_total"] = totals["amount_net"]
+
     @classmethod
     def build_init_amounts(cls, bill_update):
 
@@ -104,3 +118,67 @@ class ClaimsToBillConverter(object):
         # else line_item["discount"]
         # bill_update["amount_deduction"] += 0 if "deduction" in  line_item or not line_item["deduction"]
         # else line_item["deduction"]
+
+    @classmethod
+    def split_bill(cls, bill, bill_line_items, max_lines=None, max_amount=None):
+        """
+        split the bill when it has more than max_lines line items or an amount_total over
+        max_amount, return the list of (bill, bill line items) of each part, the code of
+        the parts being suffixed with the part number (IV-<product>-<hf>-<yyyy-mm>-<n>)
+        """
+        bill_parts = [
+            (part_number, list(part_line_items))
+            for part_number, part_line_items in cls.split_bill_line_items(
+                bill_line_items, max_lines, max_amount
+            )
+        ]
+        if len(bill_parts) <= 1:
+            return [(bill, bill_line_items)]
+        result = []
+        for part_number, part_line_items in bill_parts:
+            bill_part = cls.build_bill_part(bill, part_number)
+            for line_item in part_line_items:
+                cls.build_amounts(line_item, bill_part)
+            result.append((bill_part, part_line_items))
+        return result
+
+    @classmethod
+    def split_bill_line_items(cls, bill_line_items, max_lines=None, max_amount=None):
+        """
+        lazily group the bill line items in parts of at most max_lines line items
+        and max_amount amount_total, return an iterator of (part number, part line items)
+        """
+        part = {"number": 0, "lines": 0}
+
+        def get_part_number(line_item):
+            if part["number"] == 0 or cls.is_bill_part_full(
+                part, line_item, max_lines, max_amount
+            ):
+                part["number"] += 1
+                part["lines"] = 0
+                cls.build_init_amounts(part)
+            part["lines"] += 1
+            cls.build_amounts(line_item, part)
+            return part["number"]
+
+        return itertools.groupby(bill_line_items, key=get_part_number)
+
+    @classmethod
+    def is_bill_part_full(cls, part, line_item, max_lines=None, max_amount=None):
+        if max_lines and part["lines"] >= max_lines:
+            return True
+        # a single line item over max_amount gets its own part
+        if (
+            max_amount
+            and part["lines"] > 0
+            and part["amount_total"] + line_item["amount_total"] > max_amount
+        ):
+            return True
+        return False
+
+    @classmethod
+    def build_bill_part(cls, bill, part_number):
+        bill_part = dict(bill)
+        bill_part["code"] = f"{bill['code']}-{part_number}"
+        cls.build_init_amounts(bill_part)
+        return bill_part
@@ -0,0 +1,152 @@
+import logging
+import time
+from contextlib import contextmanager, nullcontext
+from contextvars import ContextVar
+
+from django.db import connection
+
+from calcrule_third_party_payment.apps import CalcruleThirdPartyPaymentConfig
+
+logger = logging.getLogger(__name__)
+
+# recorder of the calculation running in the current thread, None when disabled
+_current_recorder = ContextVar("calcrule_third_party_payment_recorder", default=None)
+_disabled_phase = nullcontext()
+# callables receiving the recorded phases (PhaseRecorder.as_dict) of each calculation
+_sinks = []
+
+
+class PhaseRecorder(object):
+    """
+    wall time, number and time of the queries and rows handled per named phase,
+    the time and queries of a nested phase are only counted in the nested phase
+    (queries run outside of any phase are counted in "other")
+    """
+
+    def __init__(self, name):
+        self.name = name
+        self.phases = {}
+        self._stack = []
+        self._started = time.perf_counter()
+        self._resumed = self._started
+        self.wall_time = None
+
+    def _get_phase(self, name):
+        if name not in self.phases:
+            self.phases[name] = {
+                "calls": 0,
+                "wall_time": 0,
+                "queries": 0,
+                "query_time": 0,
+                "rows": 0,
+            }
+        return self.phases[name]
+
+    def _current_phase(self):
+        return self._get_phase(self._stack[-1] if self._stack else "other")
+
+    def _account_time(self):
+        now = time.perf_counter()
+        if self._stack:
+            self._current_phase()["wall_time"] += now - self._resumed
+        self._resumed = now
+
+    @contextmanager
+    def phase(self, name):
+        self._account_time()
+        self._stack.append(name)
+        self._get_phase(name)["calls"] += 1
+        try:
+            yield self
+        finally:
+            self._account_time()
+            self._stack.pop()
+
+    def add_rows(self, count):
+        self._current_phase()["rows"] += count
+
+    def execute_wrapper(self, execute, sql, params, many, context):
+        start = time.perf_counter()
+        try:
+            return execute(sql, params, many, context)
+        finally:
+            phase = self._current_phase()
+            phase["queries"] += 1
+            phase["query_time"] += time.perf_counter() - start
+
+    def stop(self):
+        self._account_time()
+        self.wall_time = time.perf_counter() - self._started
+
+    def as_dict(self):
+        return {"name": self.name, "wall_time": self.wall_time, "phases": self.phases}
+
+
+@contextmanager
+def record_calculation(name):
+    """
+    record the phases of a calculation if the instrumentation is enabled (yield None otherwise),
+    the recorded phases are then sent to the registered sinks
+    """
+    if not CalcruleThirdPartyPaymentConfig.instrumentation:
+        yield None
+        return
+    recorder = PhaseRecorder(name)
+    token = _current_recorder.set(recorder)
+    try:
+        with connection.execute_wrapper(recorder.execute_wrapper):
+            yield recorder
+    finally:
+        _current_recorder.reset(token)
+        recorder.stop()
+        emit(recorder.as_dict())
+
+
+def phase(name):
+    """context manager recording a phase of the current calculation, if any"""
+    recorder = _current_recorder.get()
+    if recorder is None:
+        return _disabled_phase
+    return recorder.phase(name)
+
+
+def add_rows(count):
+    """add the rows handled to the current phase, if any"""
+    recorder = _current_recorder.get()
+    if recorder is not None:
+        recorder.add_rows(count)
+
+
+def register_instrumentation_sink(sink):
+    """register a callable receiving the recorded phases of each calculation (e.g. metrics exporter)"""
+    if sink not in _sinks:
+        _sinks.append(sink)
+
+
+def unregister_instrumentation_sink(sink):
+    if sink in _sinks:
+        _sinks.remove(sink)
+
+
+def emit(recorded):
+    for sink in _sinks:
+        try:
+            sink(recorded)
+        except Exception:
+            logger.exception(f"instrumentation sink {sink} failed")
+
+
+def log_instrumentation(recorded):
+    logger.info(
+        "%s: %.3fs, %s",
+        recorded["name"],
+        recorded["wall_time"],
+        ", ".join(
+            f"{name} {phase['wall_time']:.3f}s ({phase['queries']} queries "
+            f"{phase['query_time']:.3f}s, {phase['rows']} rows)"
+            for name, phase in recorded["phases"].items()
+        ),
+    )
+
+
+register_instrumentation_sink(log_instrumentation)
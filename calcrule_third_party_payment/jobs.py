@@ -0,0 +1,64 @@
+import logging
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+from django.db import connections, transaction
+
+from calcrule_third_party_payment.apps import CalcruleThirdPartyPaymentConfig
+from calcrule_third_party_payment.models import ConversionJob
+
+logger = logging.getLogger(__name__)
+
+EXECUTOR_THREAD = "thread"
+EXECUTOR_INLINE = "inline"
+
+_executor = None
+_executor_lock = threading.Lock()
+
+
+def get_executor():
+    global _executor
+    with _executor_lock:
+        if _executor is None:
+            _executor = ThreadPoolExecutor(
+                max_workers=CalcruleThirdPartyPaymentConfig.background_conversion_workers,
+                thread_name_prefix="calcrule_third_party_payment",
+            )
+    return _executor
+
+
+def submit_conversion_job(job, run, executor=None):
+    """
+    run(job_id) once the current transaction is committed (the job and the valuated
+    claims are then visible to the job), in the thread pool or in-process (inline),
+    by default as set by background_conversion_executor
+    """
+    job_id = job.id
+    if executor is None:
+        executor = CalcruleThirdPartyPaymentConfig.background_conversion_executor
+    if executor == EXECUTOR_INLINE:
+        transaction.on_commit(lambda: run(job_id))
+    else:
+        transaction.on_commit(
+            lambda: get_executor().submit(_run_in_thread, run, job_id)
+        )
+
+
+def _run_in_thread(run, job_id):
+    # each worker thread opens its own database connection, close it when done
+    try:
+        run(job_id)
+    except Exception:
+        logger.exception(f"conversion job {job_id} failed")
+    finally:
+        connections.close_all()
+
+
+def get_conversion_progress(batch_run_id):
+    """progress (see ConversionJob.get_progress) of the conversion jobs of the batch run"""
+    return [
+        job.get_progress()
+        for job in ConversionJob.objects.filter(batch_run_id=batch_run_id).order_by(
+            "date_created"
+        )
+    ]
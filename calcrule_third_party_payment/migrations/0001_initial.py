@@ -0,0 +1,95 @@
+import datetime
+import uuid
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+import core.fields
+
+
+class Migration(migrations.Migration):
+
+    initial = True
+
+    dependencies = []
+
+    operations = [
+        migrations.CreateModel(
+            name="ConversionJob",
+            fields=[
+                (
+                    "id",
+                    models.UUIDField(
+                        default=uuid.uuid4,
+                        editable=False,
+                        primary_key=True,
+                        serialize=False,
+                    ),
+                ),
+                ("batch_run_id", models.IntegerField(db_index=True)),
+                ("payment_plan_id", models.UUIDField()),
+                ("product_id", models.IntegerField()),
+                ("start_date", core.fields.DateField()),
+                ("end_date", core.fields.DateTimeField()),
+                (
+                    "status",
+                    models.CharField(
+                        choices=[
+                            ("pending", "pending"),
+                            ("running", "running"),
+                            ("done", "done"),
+                            ("failed", "failed"),
+                        ],
+                        default="pending",
+                        max_length=10,
+                    ),
+                ),
+                ("total", models.IntegerField(default=0)),
+                ("error", models.TextField(blank=True, null=True)),
+                (
+                    "date_created",
+                    core.fields.DateTimeField(default=datetime.datetime.now),
+                ),
+                ("date_started", core.fields.DateTimeField(blank=True, null=True)),
+                ("date_finished", core.fields.DateTimeField(blank=True, null=True)),
+            ],
+            options={
+                "unique_together": {("batch_run_id", "payment_plan_id")},
+            },
+        ),
+        migrations.CreateModel(
+            name="ConversionCheckpoint",
+            fields=[
+                (
+                    "id",
+                    models.AutoField(primary_key=True, serialize=False),
+                ),
+                ("health_facility_id", models.IntegerField()),
+                (
+                    "status",
+                    models.CharField(
+                        choices=[("done", "done"), ("failed", "failed")],
+                        max_length=10,
+                    ),
+                ),
+                ("bill_id", models.UUIDField(blank=True, null=True)),
+                ("bill_count", models.IntegerField(default=0)),
+                ("error", models.TextField(blank=True, null=True)),
+                (
+                    "date_updated",
+                    core.fields.DateTimeField(default=datetime.datetime.now),
+                ),
+                (
+                    "job",
+                    models.ForeignKey(
+                        on_delete=django.db.models.deletion.CASCADE,
+                        related_name="checkpoints",
+                        to="calcrule_third_party_payment.conversionjob",
+                    ),
+                ),
+            ],
+            options={
+                "unique_together": {("job", "health_facility_id")},
+            },
+        ),
+    ]
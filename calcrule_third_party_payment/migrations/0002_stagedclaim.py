@@ -0,0 +1,27 @@
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("calcrule_third_party_payment", "0001_initial"),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name="StagedClaim",
+            fields=[
+                ("id", models.AutoField(primary_key=True, serialize=False)),
+                ("stage_id", models.UUIDField()),
+                ("claim_id", models.IntegerField()),
+            ],
+            options={
+                "indexes": [
+                    models.Index(
+                        fields=["stage_id", "claim_id"],
+                        name="calcrule_tpp_staged_claim",
+                    )
+                ],
+            },
+        ),
+    ]
@@ -1 +1,122 @@
-# Create your models here.
+import uuid
+from datetime import datetime as py_datetime
+
+from django.db import models
+from django.db.models import Count
+
+from core import fields
+
+
+class ConversionJob(models.Model):
+    """
+    background BatchPayment conversion of a payment plan for a batch run,
+    the batch run, payment plan and product are kept as plain ids so that
+    the job can be resumed (see ThirdPartyPaymentCalculationRule.run_conversion_job)
+    """
+
+    STATUS_PENDING = "pending"
+    STATUS_RUNNING = "running"
+    STATUS_DONE = "done"
+    STATUS_FAILED = "failed"
+    STATUS_CHOICES = (
+        (STATUS_PENDING, STATUS_PENDING),
+        (STATUS_RUNNING, STATUS_RUNNING),
+        (STATUS_DONE, STATUS_DONE),
+        (STATUS_FAILED, STATUS_FAILED),
+    )
+    # statuses of the jobs that can be (re)run
+    RUNNABLE_STATUSES = (STATUS_PENDING, STATUS_FAILED)
+
+    id = models.UUIDField(primary_key=True, default=uuid.uuid4, editable=False)
+    batch_run_id = models.IntegerField(db_index=True)
+    payment_plan_id = models.UUIDField()
+    product_id = models.IntegerField()
+    start_date = fields.DateField()
+    end_date = fields.DateTimeField()
+    status = models.CharField(
+        max_length=10, choices=STATUS_CHOICES, default=STATUS_PENDING
+    )
+    # number of health facilities to convert
+    total = models.IntegerField(default=0)
+    error = models.TextField(blank=True, null=True)
+    date_created = fields.DateTimeField(default=py_datetime.now)
+    date_started = fields.DateTimeField(blank=True, null=True)
+    date_finished = fields.DateTimeField(blank=True, null=True)
+
+    def get_progress(self):
+        """processed/total health facilities and estimated remaining seconds of a running job"""
+        counts = dict(
+            self.checkpoints.order_by()
+            .values_list("status")
+            .annotate(count=Count("id"))
+            .values_list("status", "count")
+        )
+        done = counts.get(ConversionCheckpoint.STATUS_DONE, 0)
+        failed = counts.get(ConversionCheckpoint.STATUS_FAILED, 0)
+        eta = None
+        if self.status == self.STATUS_RUNNING and self.date_started:
+            # rate of this (possibly resumed) run only
+            processed_since_start = self.checkpoints.filter(
+                date_updated__gte=self.date_started
+            ).count()
+            if processed_since_start:
+                elapsed = (py_datetime.now() - self.date_started).total_seconds()
+                remaining = max(self.total - done - failed, 0)
+                eta = elapsed / processed_since_start * remaining
+        return {
+            "job_id": str(self.id),
+            "batch_run_id": self.batch_run_id,
+            "payment_plan_id": str(self.payment_plan_id),
+            "status": self.status,
+            "total": self.total,
+            "processed": done + failed,
+            "done": done,
+            "failed": failed,
+            "eta_seconds": eta,
+        }
+
+    class Meta:
+        unique_together = ("batch_run_id", "payment_plan_id")
+
+
+class ConversionCheckpoint(models.Model):
+    """conversion of a health facility by a ConversionJob, done ones are skipped when resuming"""
+
+    STATUS_DONE = "done"
+    STATUS_FAILED = "failed"
+    STATUS_CHOICES = (
+        (STATUS_DONE, STATUS_DONE),
+        (STATUS_FAILED, STATUS_FAILED),
+    )
+
+    id = models.AutoField(primary_key=True)
+    job = models.ForeignKey(ConversionJob, models.CASCADE, related_name="checkpoints")
+    health_facility_id = models.IntegerField()
+    status = models.CharField(max_length=10, choices=STATUS_CHOICES)
+    # first bill of the health facility (several ones if split), None if nothing to bill
+    bill_id = models.UUIDField(blank=True, null=True)
+    bill_count = models.IntegerField(default=0)
+    error = models.TextField(blank=True, null=True)
+    date_updated = fields.DateTimeField(default=py_datetime.now)
+
+    class Meta:
+        unique_together = ("job", "health_facility_id")
+
+
+class StagedClaim(models.Model):
+    """
+    eligible claims of a batch calculation, too many to be kept as a list of ids: staged once
+    so that the following statements filter on this table instead of evaluating the claims
+    query again (see utils.stage_claim_ids), deleted when the calculation is done
+    """
+
+    id = models.AutoField(primary_key=True)
+    stage_id = models.UUIDField()
+    claim_id = models.IntegerField()
+
+    class Meta:
+        indexes = [
+            models.Index(
+                fields=["stage_id", "claim_id"], name="calcrule_tpp_staged_claim"
+            )
+        ]
@@ -0,0 +1,75 @@
+import cProfile
+import logging
+import os
+import tracemalloc
+from contextlib import contextmanager
+
+from calcrule_third_party_payment.apps import CalcruleThirdPartyPaymentConfig
+
+logger = logging.getLogger(__name__)
+
+TRACEMALLOC_TOP_ALLOCATIONS = 50
+
+
+def is_profiling_enabled(context, payment_plan):
+    if not CalcruleThirdPartyPaymentConfig.profiling_directory:
+        return False
+    if context in CalcruleThirdPartyPaymentConfig.profiling_contexts:
+        return True
+    payment_plan_uuids = {
+        str(payment_plan_uuid).lower()
+        for payment_plan_uuid in CalcruleThirdPartyPaymentConfig.profiling_payment_plans
+    }
+    return str(payment_plan.id).lower() in payment_plan_uuids
+
+
+@contextmanager
+def profile_calculation(context, payment_plan, work_data=None):
+    """
+    profile the calculation of the payment plan if its context or uuid is configured:
+    the cProfile stats (.prof) and the top tracemalloc allocations (.txt) are written
+    to the profiling directory as <batch run id>_<context>_<payment plan uuid>
+    """
+    if not is_profiling_enabled(context, payment_plan):
+        yield
+        return
+    batch_run = work_data.get("created_run") if work_data else None
+    file_name = os.path.join(
+        CalcruleThirdPartyPaymentConfig.profiling_directory,
+        f"{batch_run.id if batch_run else 'no_batch_run'}_{context}_{payment_plan.id}",
+    )
+    profiler = cProfile.Profile()
+    try:
+        profiler.enable()
+    except ValueError:
+        # another profiler is already active in this thread
+        logger.warning(f"cannot profile {file_name}, a profiler is already active")
+        profiler = None
+    # do not stop the memory tracing if it was started by someone else
+    start_tracemalloc = not tracemalloc.is_tracing()
+    if start_tracemalloc:
+        tracemalloc.start()
+    try:
+        yield
+    finally:
+        if profiler is not None:
+            profiler.disable()
+        snapshot = tracemalloc.take_snapshot()
+        if start_tracemalloc:
+            tracemalloc.stop()
+        try:
+            os.makedirs(
+                CalcruleThirdPartyPaymentConfig.profiling_directory, exist_ok=True
+            )
+            if profiler is not None:
+                profiler.dump_stats(f"{file_name}.prof")
+            with open(f"{file_name}.txt", "w") as allocations_file:
+                for statistic in snapshot.statistics("lineno")[
+                    :TRACEMALLOC_TOP_ALLOCATIONS
+                ]:
+                    allocations_file.write(f"{statistic}\n")
+            logger.info(
+                f"profile of {context} {payment_plan.code} written to {file_name}"
+            )
+        except OSError:
+            logger.exception(f"cannot write the profile {file_name}")
@@ -0,0 +1,109 @@
+import uuid
+from datetime import datetime as py_datetime
+
+from django.db import transaction
+from simple_history.utils import bulk_create_with_history
+
+from calcrule_third_party_payment.converters import BillLineItem, ClaimsToBillConverter
+from invoice.models import Bill, BillItem
+
+
+def bulk_create_bills(convert_results_list, user, batch_size=1000):
+    """
+    save the bills (and their line items) of several claims to bill conversions
+    with bulk inserts in a single transaction, the bill primary keys are
+    assigned beforehand so that the line items are linked without reading the bills back
+    unlike BillService.bill_create, the bill validation and service signals are not run
+    """
+    now = py_datetime.now()
+    bills = []
+    bill_items = []
+    for convert_results in convert_results_list:
+        bill = _build_history_object(Bill, convert_results["bill_data"], user, now)
+        bills.append(bill)
+        for bill_line_item in convert_results["bill_data_line"]:
+            bill_items.append(
+                _build_history_object(BillItem, bill_line_item, user, now, bill=bill)
+            )
+    with transaction.atomic():
+        bulk_create_with_history(
+            bills, Bill, batch_size=batch_size, default_user=user
+        )
+        bulk_create_with_history(
+            bill_items, BillItem, batch_size=batch_size, default_user=user
+        )
+    return bills
+
+
+def create_bill_streaming(
+    convert_results, user, chunk_size=1000, max_lines=None, max_amount=None
+):
+    """
+    save the bill then its line items, consumed from the (lazy) bill_data_line
+    and inserted by chunks of chunk_size, so that they are never all in memory;
+    the bill amounts are added up while the line items are saved.
+    When max_lines or max_amount is reached a new bill is started, the bills being
+    then suffixed with their part number (see ClaimsToBillConverter.split_bill)
+    """
+    bill_data = convert_results["bill_data"]
+    now = py_datetime.now()
+    bills = []
+    with transaction.atomic():
+        for part_number, part_line_items in ClaimsToBillConverter.split_bill_line_items(
+            convert_results["bill_data_line"], max_lines, max_amount
+        ):
+            bill_part = ClaimsToBillConverter.build_bill_part(bill_data, part_number)
+            if part_number == 1:
+                bill_part["code"] = bill_data["code"]
+            elif part_number == 2:
+                # the bill is split after all, suffix the first part
+                _update_bill(bills[0], code=f"{bill_data['code']}-1")
+            bills.append(
+                _create_bill_part_streaming(
+                    bill_part, part_line_items, user, now, chunk_size
+                )
+            )
+    return bills
+
+
+def _create_bill_part_streaming(bill_data, bill_line_items, user, now, chunk_size):
+    bill = _build_history_object(Bill, bill_data, user, now)
+    bulk_create_with_history([bill], Bill, default_user=user)
+    chunk = []
+    for bill_line_item in bill_line_items:
+        ClaimsToBillConverter.build_amounts(bill_line_item, bill_data)
+        chunk.append(
+            _build_history_object(BillItem, bill_line_item, user, now, bill=bill)
+        )
+        if len(chunk) >= chunk_size:
+            bulk_create_with_history(chunk, BillItem, default_user=user)
+            chunk = []
+    if chunk:
+        bulk_create_with_history(chunk, BillItem, default_user=user)
+    _update_bill(
+        bill, amount_net=bill_data["amount_net"], amount_total=bill_data["amount_total"]
+    )
+    return bill
+
+
+def _update_bill(bill, **fields):
+    # the bill was saved with bulk_create_with_history, its history row is updated too
+    for field, value in fields.items():
+        setattr(bill, field, value)
+    Bill.objects.filter(id=bill.id).update(**fields)
+    Bill.history.filter(id=bill.id).update(**fields)
+
+
+def _build_history_object(model, data, user, now, **kwargs):
+    # same fields as set by HistoryModel.save for a new object
+    if isinstance(data, BillLineItem):
+        # the line item record is set on the model without an intermediate dict
+        obj = data.apply_to(model(**kwargs))
+    else:
+        obj = model(**data, **kwargs)
+    obj.id = uuid.uuid4()
+    obj.user_created = user
+    obj.user_updated = user
+    obj.date_created = now
+    obj.date_updated = now
+    return obj
@@ -0,0 +1,44 @@
+from django.db.models.signals import post_delete, post_save
+
+from calcrule_third_party_payment.utils import (
+    check_calculation_cache,
+    compiled_payment_plan_cache,
+)
+from contribution_plan.models import PaymentPlan
+from location.models import HealthFacility, Location
+from product.models import Product
+
+
+def bind_cache_invalidation():
+    # the check_calculation results depend on the payment plans, the products
+    # and the locations (directly or through the health facility)
+    for sender in [PaymentPlan, Product, Location, HealthFacility]:
+        post_save.connect(
+            on_check_calculation_dependency_change,
+            sender=sender,
+            dispatch_uid=f"calcrule_third_party_payment_{sender.__name__}_post_save",
+        )
+        post_delete.connect(
+            on_check_calculation_dependency_change,
+            sender=sender,
+            dispatch_uid=f"calcrule_third_party_payment_{sender.__name__}_post_delete",
+        )
+    # the compiled payment plan parameters and filters
+    post_save.connect(
+        on_payment_plan_change,
+        sender=PaymentPlan,
+        dispatch_uid="calcrule_third_party_payment_compiled_payment_plan_post_save",
+    )
+    post_delete.connect(
+        on_payment_plan_change,
+        sender=PaymentPlan,
+        dispatch_uid="calcrule_third_party_payment_compiled_payment_plan_post_delete",
+    )
+
+
+def on_check_calculation_dependency_change(sender, **kwargs):
+    check_calculation_cache.clear()
+
+
+def on_payment_plan_change(sender, **kwargs):
+    compiled_payment_plan_cache.clear()
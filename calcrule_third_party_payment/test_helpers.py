@@ -0,0 +1,260 @@
+import calendar
+import datetime
+from datetime import date, timedelta
+
+from django.contrib.contenttypes.models import ContentType
+
+from calcrule_third_party_payment.services import bulk_create_bills
+from claim.models import Claim
+from claim.services import submit_claim, validate_and_process_dedrem_claim
+from claim.test_helpers import (
+    create_test_claim,
+    create_test_claimitem,
+    create_test_claimservice,
+)
+from contribution.test_helpers import create_test_payer, create_test_premium
+from contribution_plan.tests.helpers import create_test_payment_plan
+from core.services import create_or_update_core_user, create_or_update_interactive_user
+from core.test_helpers import create_test_interactive_user
+from insuree.test_helpers import create_test_insuree
+from location.models import HealthFacility
+from location.test_helpers import create_test_health_facility, create_test_location
+from medical.test_helpers import create_test_item, create_test_service
+from medical_pricelist.test_helpers import (
+    add_item_to_hf_pricelist,
+    add_service_to_hf_pricelist,
+    create_test_item_pricelist,
+    create_test_service_pricelist,
+)
+from policy.test_helpers import create_test_policy
+from product.models import ProductItemOrService
+from product.test_helpers import (
+    create_test_product,
+    create_test_product_item,
+    create_test_product_service,
+)
+
+THIRD_PARTY_PAYMENT_CALCULATION_UUID = "0a1b6d54-eef4-4ee6-ac47-2a99cfa5e9a8"
+
+TEST_CALCULATION_RULE_PARAMS = {
+    "hf_level_1": HealthFacility.LEVEL_HOSPITAL,
+    "hf_sublevel_1": "null",
+    "hf_level_2": HealthFacility.LEVEL_DISPENSARY,
+    "hf_sublevel_2": "null",
+    "hf_level_3": HealthFacility.LEVEL_HEALTH_CENTER,
+    "hf_sublevel_3": "null",
+    "hf_level_4": "null",
+    "hf_sublevel_4": "null",
+    **{f"distr_{month}": 100 for month in range(1, 13)},
+    "claim_type": "B",
+}
+
+
+def get_test_user_data(username):
+    return {
+        "username": username,
+        "last_name": username,
+        "password": username,
+        "other_names": username,
+        "user_types": "INTERACTIVE",
+        "language": "en",
+        "roles": [1, 5, 9],
+    }
+
+
+class BatchRunUserMixin(object):
+    """setUp of the test cases running batch runs, self.user is the core user running them"""
+
+    test_user_name = "test_batch_run"
+
+    def setUp(self) -> None:
+        super(BatchRunUserMixin, self).setUp()
+        i_user, i_user_created = create_or_update_interactive_user(
+            user_id=None,
+            data=get_test_user_data(self.test_user_name),
+            audit_user_id=999,
+            connected=False,
+        )
+        user, user_created = create_or_update_core_user(
+            user_uuid=None, username=self.test_user_name, i_user=i_user
+        )
+        self.user = user
+
+
+TEST_HF_LEVELS = [
+    HealthFacility.LEVEL_HOSPITAL,
+    HealthFacility.LEVEL_DISPENSARY,
+    HealthFacility.LEVEL_HEALTH_CENTER,
+]
+
+
+def create_test_batch_dataset(
+    facilities=1, claims=1, details=1, user=None, service_quantity=1, item_quantity=1
+):
+    """
+    create a region with a fee for service payment plan and `facilities` health facilities
+    (cycling through the hospital, dispensary and health center levels), each with `claims`
+    processed claims (alternating out and in patient) of `details` items and `details` services
+    with relative prices (100 per unit); return the created objects, the errors of the claims
+    processing and the end date of the batch run
+    """
+    if user is None:
+        user = create_test_interactive_user()
+    test_region = create_test_location("R")
+    test_district = create_test_location(
+        "D", custom_props={"parent_id": test_region.id}
+    )
+    insuree = create_test_insuree()
+    service = create_test_service("A", custom_props={"name": "test_batch_dataset"})
+    item = create_test_item("A", custom_props={"name": "test_batch_dataset"})
+    product = create_test_product(
+        "CRTPB",
+        custom_props={
+            "name": "batchdataset",
+            "lump_sum": 10_000,
+            "location_id": test_region.id,
+        },
+    )
+    payment_plan = create_test_payment_plan(
+        product=product,
+        calculation=THIRD_PARTY_PAYMENT_CALCULATION_UUID,
+        custom_props={
+            "periodicity": 1,
+            "date_valid_from": "2019-01-01",
+            "date_valid_to": "2050-01-01",
+            "json_ext": {"calculation_rule": dict(TEST_CALCULATION_RULE_PARAMS)},
+        },
+    )
+    create_test_product_service(
+        product,
+        service,
+        custom_props={"price_origin": ProductItemOrService.ORIGIN_RELATIVE},
+    )
+    create_test_product_item(
+        product,
+        item,
+        custom_props={"price_origin": ProductItemOrService.ORIGIN_RELATIVE},
+    )
+    policy = create_test_policy(
+        product,
+        insuree,
+        link=True,
+        custom_props={
+            "effective_date": date.today() - timedelta(days=200),
+            "expiry_date": date.today() + timedelta(days=165),
+            "start_date": date.today() - timedelta(days=200),
+            "value": 1000,
+        },
+    )
+    payer = create_test_payer()
+    create_test_premium(
+        policy_id=policy.id,
+        custom_props={
+            "payer_id": payer.id,
+            "amount": 1000,
+            "pay_date": date.today() - timedelta(days=200),
+            "created_date": datetime.datetime.now() - timedelta(days=200),
+        },
+    )
+    test_item_price_list = create_test_item_pricelist(test_region.id)
+    test_service_price_list = create_test_service_pricelist(test_region.id)
+
+    health_facilities = []
+    test_claims = []
+    errors = []
+    date_from = datetime.datetime.now() - timedelta(days=2)
+    for hf_index in range(facilities):
+        health_facility = create_test_health_facility(
+            f"HFB{hf_index}",
+            test_district.id,
+            custom_props={
+                "level": TEST_HF_LEVELS[hf_index % len(TEST_HF_LEVELS)],
+                "services_pricelist_id": test_service_price_list.id,
+                "items_pricelist_id": test_item_price_list.id,
+            },
+        )
+        add_service_to_hf_pricelist(service, health_facility.id)
+        add_item_to_hf_pricelist(item, health_facility.id)
+        health_facilities.append(health_facility)
+        for claim_index in range(claims):
+            claim = create_test_claim(
+                {
+                    "claimed": 100 * (service_quantity + item_quantity) * details,
+                    "insuree_id": insuree.id,
+                    "health_facility_id": health_facility.id,
+                    "date_from": date_from,
+                    # every other claim is an in-patient one
+                    "date_to": date_from + timedelta(days=claim_index % 2),
+                }
+            )
+            for _ in range(details):
+                create_test_claimservice(
+                    claim,
+                    custom_props={
+                        "price_asked": 100,
+                        "service_id": service.id,
+                        "qty_provided": service_quantity,
+                        "price_origin": ProductItemOrService.ORIGIN_RELATIVE,
+                    },
+                )
+                create_test_claimitem(
+                    claim,
+                    "A",
+                    custom_props={
+                        "price_asked": 100,
+                        "item_id": item.id,
+                        "qty_provided": item_quantity,
+                        "price_origin": ProductItemOrService.ORIGIN_RELATIVE,
+                    },
+                )
+            claim.refresh_from_db()
+            errors += submit_claim(claim, user)
+            errors += validate_and_process_dedrem_claim(claim, user, True)
+            claim.process_stamp = claim.validity_from
+            claim.save()
+            test_claims.append(claim)
+
+    date_processed = test_claims[0].date_processed if test_claims else date.today()
+    days_in_month = calendar.monthrange(date_processed.year, date_processed.month)[1]
+    return {
+        "region": test_region,
+        "product": product,
+        "payment_plan": payment_plan,
+        "health_facilities": health_facilities,
+        "claims": test_claims,
+        "errors": errors,
+        "end_date": datetime.datetime(
+            date_processed.year, date_processed.month, days_in_month
+        ),
+    }
+
+
+def create_test_claim_bill(claims, user, code):
+    """bill the claims (e.g. a previous partial run of a batch run), one line item per claim"""
+    claim_type = ContentType.objects.get_for_model(Claim)
+    bill_line_items = [
+        {
+            "line_type": claim_type,
+            "line_id": claim.id,
+            "code": claim.code,
+            "quantity": 1,
+            "unit_price": claim.claimed,
+            "amount_net": claim.claimed,
+            "amount_total": claim.claimed,
+        }
+        for claim in claims
+    ]
+    amount = sum(claim.claimed for claim in claims)
+    return bulk_create_bills(
+        [
+            {
+                "bill_data": {
+                    "code": code,
+                    "amount_net": amount,
+                    "amount_total": amount,
+                },
+                "bill_data_line": bill_line_items,
+            }
+        ],
+        user,
+    )[0]
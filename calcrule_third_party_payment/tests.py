@@ -1,19 +1,71 @@
 import calendar
 import datetime
 import decimal
+import os
+import shutil
+import tempfile
+import threading
+import uuid
+from contextlib import contextmanager
 from datetime import date, timedelta
+from unittest import mock
 
-from django.test import TestCase
+from django.contrib.contenttypes.models import ContentType
+from django.db import connection, connections, transaction
+from django.test import SimpleTestCase, TestCase, TransactionTestCase
+from django.test.utils import CaptureQueriesContext
 
-from claim.models import Claim, ClaimDedRem
+from claim.models import Claim, ClaimDedRem, ClaimItem, ClaimService
 from claim.services import submit_claim, validate_and_process_dedrem_claim
 from claim.test_helpers import (
     create_test_claim,
     create_test_claimitem,
     create_test_claimservice,
 )
-from claim_batch.services import do_process_batch
+from calcrule_third_party_payment.apps import CalcruleThirdPartyPaymentConfig
+from calcrule_third_party_payment.calculation_rule import (
+    ThirdPartyPaymentCalculationRule,
+)
+from calcrule_third_party_payment.converters import (
+    BillLineItem,
+    ClaimsToBillConverter,
+)
+from calcrule_third_party_payment.instrumentation import (
+    PhaseRecorder,
+    add_rows,
+    phase,
+    record_calculation,
+    register_instrumentation_sink,
+    unregister_instrumentation_sink,
+)
+from calcrule_third_party_payment.models import (
+    ConversionCheckpoint,
+    ConversionJob,
+    StagedClaim,
+)
+from calcrule_third_party_payment.profiling import (
+    is_profiling_enabled,
+    profile_calculation,
+)
+from calcrule_third_party_payment.services import (
+    create_bill_streaming,
+)
+from calcrule_third_party_payment.test_helpers import (
+    BatchRunUserMixin,
+    create_test_batch_dataset,
+    create_test_claim_bill,
+)
+from calcrule_third_party_payment.utils import (
+    check_calculation_cache,
+    get_compiled_payment_plan,
+    get_health_facility_bill_totals,
+    rebuild_linked_class_map,
+    release_staged_claims,
+)
+from claim_batch.models import BatchRun, RelativeIndex
+from claim_batch.services import do_process_batch, get_start_date, update_work_data
 from contribution.test_helpers import create_test_payer, create_test_premium
+from contribution_plan.models import PaymentPlan
 from contribution_plan.tests.helpers import create_test_payment_plan
 from core.services import create_or_update_core_user, create_or_update_interactive_user
 from core.test_helpers import create_test_interactive_user
@@ -241,3 +293,1019 @@ class BatchRunFeeForServiceTest(TestCase):
         )
 
         # tearDown
+
+
+class CheckCalculationTest(TestCase):
+    def test_claim_product_assigned_after_check(self):
+        dataset = create_test_batch_dataset(user=create_test_interactive_user())
+        claim = dataset["claims"][0]
+        for svc_item in [ClaimItem, ClaimService]:
+            svc_item.objects.filter(claim=claim).update(product=None)
+        self.assertFalse(ThirdPartyPaymentCalculationRule.check_calculation(claim))
+        # the product is set when the claim is processed, without any signal
+        for svc_item in [ClaimItem, ClaimService]:
+            svc_item.objects.filter(claim=claim).update(product=dataset["product"])
+        self.assertTrue(ThirdPartyPaymentCalculationRule.check_calculation(claim))
+
+    def test_payment_plans_of_other_benefit_plan_types(self):
+        dataset = create_test_batch_dataset(user=create_test_interactive_user())
+        other_product = create_test_product("CRTPO", custom_props={"name": "other"})
+        # payment plans of this calculation on benefit plans which are not products,
+        # with a uuid id or with the id of another product
+        payment_plan_type = ContentType.objects.get_for_model(PaymentPlan)
+        for code, benefit_plan_id in [
+            ("CRTPU", str(uuid.uuid4())),
+            ("CRTPI", str(other_product.id)),
+        ]:
+            payment_plan = create_test_payment_plan(
+                product=dataset["product"],
+                calculation=ThirdPartyPaymentCalculationRule.uuid,
+                custom_props={"code": code},
+            )
+            PaymentPlan.objects.filter(id=payment_plan.id).update(
+                benefit_plan_type=payment_plan_type, benefit_plan_id=benefit_plan_id
+            )
+        check_calculation_cache.clear()
+        self.assertTrue(
+            ThirdPartyPaymentCalculationRule.check_calculation(dataset["claims"][0])
+        )
+        self.assertTrue(
+            ThirdPartyPaymentCalculationRule.check_calculation(dataset["product"])
+        )
+        self.assertFalse(
+            ThirdPartyPaymentCalculationRule.check_calculation(other_product)
+        )
+
+
+class BillTotalsTest(TestCase):
+    # claimed, remunerated
+    CLAIM_AMOUNTS = [
+        (None, None),
+        (None, "100.00"),
+        ("0.00", "100.00"),
+        ("100.00", None),
+        ("100.00", "0.00"),
+        ("0.00", "0.00"),
+        ("100.00", "100.00"),
+        ("150.50", "100.25"),
+        ("80.00", "120.00"),
+    ]
+
+    def test_header_amount_is_the_sum_of_the_lines(self):
+        dataset = create_test_batch_dataset(
+            claims=len(self.CLAIM_AMOUNTS), user=create_test_interactive_user()
+        )
+        health_facility = dataset["health_facilities"][0]
+        for claim, (claimed, remunerated) in zip(dataset["claims"], self.CLAIM_AMOUNTS):
+            Claim.objects.filter(id=claim.id).update(
+                claimed=claimed and decimal.Decimal(claimed),
+                remunerated=remunerated and decimal.Decimal(remunerated),
+            )
+        claims = Claim.objects.filter(id__in=[claim.id for claim in dataset["claims"]])
+        batch_run = BatchRun.objects.create(
+            location_id=dataset["region"].id,
+            run_year=dataset["end_date"].year,
+            run_month=dataset["end_date"].month,
+            run_date=datetime.datetime.now(),
+            audit_user_id=999,
+            validity_from=datetime.datetime.now(),
+        )
+        totals = get_health_facility_bill_totals(claims)
+        self.assertEqual(
+            totals[health_facility.id]["claim_count"], len(self.CLAIM_AMOUNTS)
+        )
+        # header amounts from the grouped totals, then added up from the line items
+        for health_facility_totals in [totals, None]:
+            with self.subTest(totals=health_facility_totals is not None):
+                results = ThirdPartyPaymentCalculationRule._convert_claims(
+                    claims,
+                    health_facility=health_facility,
+                    work_data={"created_run": batch_run},
+                    billed_claim_ids=set(),
+                    health_facility_totals=health_facility_totals,
+                )
+                amount_net = sum(
+                    line_item["amount_net"] for line_item in results["bill_data_line"]
+                )
+                self.assertEqual(results["bill_data"]["amount_net"], amount_net)
+                self.assertEqual(results["bill_data"]["amount_total"], amount_net)
+
+
+class BilledClaimsTest(BatchRunUserMixin, TestCase):
+    def test_rerun_bills_the_claims_left(self):
+        dataset = create_test_batch_dataset(
+            claims=3, user=create_test_interactive_user()
+        )
+        health_facility = dataset["health_facilities"][0]
+        billed_claim, *claims_left = dataset["claims"]
+        # a previous run billed one claim of the health facility
+        bill_code = (
+            f"IV-{dataset['product'].code}-{health_facility.code}"
+            f"-{date.today().strftime('%Y-%m')}"
+        )
+        create_test_claim_bill([billed_claim], self.user, bill_code)
+
+        batch_run = do_process_batch(
+            self.user.id_for_audit, dataset["region"].id, dataset["end_date"]
+        )
+
+        bill = Bill.objects.get(subject_id=batch_run.id)
+        self.assertEqual(bill.code, f"{bill_code}-R1")
+        self.assertEqual(
+            set(bill.line_items_bill.values_list("line_id", flat=True)),
+            {str(claim.id) for claim in claims_left},
+        )
+        self.assertEqual(
+            BillItem.objects.filter(line_id=str(billed_claim.id)).count(), 1
+        )
+
+
+class ParallelConversionTest(BatchRunUserMixin, TransactionTestCase):
+    """
+    the workers of the parallel conversion read on their own database connection,
+    the batch run must then be committed (no TestCase transaction), in a transaction
+    the conversion runs as a job once it is committed
+    """
+
+    # keep the data of the migrations for the next tests
+    serialized_rollback = True
+
+    def test_parallel_conversion(self):
+        dataset = create_test_batch_dataset(
+            facilities=3, claims=2, user=create_test_interactive_user()
+        )
+        with self._parallel_conversion() as convert_in_worker:
+            batch_run = do_process_batch(
+                self.user.id_for_audit, dataset["region"].id, dataset["end_date"]
+            )
+        self.assertEqual(convert_in_worker.call_count, 3)
+        self._assert_billed(batch_run, dataset)
+
+    def test_parallel_conversion_after_commit(self):
+        with self._parallel_conversion() as convert_in_worker:
+            # e.g. claim_batch.services.process_batch
+            with transaction.atomic():
+                dataset = create_test_batch_dataset(
+                    facilities=3, claims=2, user=create_test_interactive_user()
+                )
+                batch_run = do_process_batch(
+                    self.user.id_for_audit, dataset["region"].id, dataset["end_date"]
+                )
+                # converted as a job once the batch run is committed
+                self.assertFalse(Bill.objects.filter(subject_id=batch_run.id).exists())
+                convert_in_worker.assert_not_called()
+        self.assertEqual(convert_in_worker.call_count, 3)
+        job = ConversionJob.objects.get(batch_run_id=batch_run.id)
+        self.assertEqual(job.status, ConversionJob.STATUS_DONE)
+        self._assert_billed(batch_run, dataset)
+
+    @staticmethod
+    @contextmanager
+    def _parallel_conversion():
+        with mock.patch.multiple(
+            CalcruleThirdPartyPaymentConfig,
+            parallel_conversion=True,
+            parallel_conversion_workers=2,
+            streaming_conversion=False,
+            per_facility_commit=False,
+            background_conversion=False,
+        ), mock.patch.object(
+            ThirdPartyPaymentCalculationRule,
+            "_convert_in_worker",
+            wraps=ThirdPartyPaymentCalculationRule._convert_in_worker,
+        ) as convert_in_worker:
+            yield convert_in_worker
+
+    def _assert_billed(self, batch_run, dataset):
+        for health_facility in dataset["health_facilities"]:
+            bill = Bill.objects.get(
+                subject_id=batch_run.id, thirdparty_id=health_facility.id
+            )
+            self.assertEqual(
+                set(bill.line_items_bill.values_list("line_id", flat=True)),
+                {
+                    str(claim.id)
+                    for claim in dataset["claims"]
+                    if claim.health_facility_id == health_facility.id
+                },
+            )
+        self.assertFalse(
+            Claim.objects.filter(
+                id__in=[claim.id for claim in dataset["claims"]],
+                remunerated__isnull=True,
+            ).exists()
+        )
+
+
+class PerFacilityCommitTest(BatchRunUserMixin, TransactionTestCase):
+    """
+    the bills committed are read on the connection of another thread,
+    the batch run must then be committed (no TestCase transaction)
+    """
+
+    # keep the data of the migrations for the next tests
+    serialized_rollback = True
+
+    def test_each_health_facility_is_committed(self):
+        commit_health_facility = (
+            ThirdPartyPaymentCalculationRule._commit_health_facility
+        )
+        # health facilities with a committed bill when each health facility is committed
+        committed = []
+
+        def checking_commit(*args, **kwargs):
+            committed.append(self._committed_health_facility_ids(dataset))
+            return commit_health_facility(*args, **kwargs)
+
+        with mock.patch.multiple(
+            CalcruleThirdPartyPaymentConfig,
+            per_facility_commit=True,
+            parallel_conversion=False,
+            background_conversion=False,
+        ), mock.patch.object(
+            ThirdPartyPaymentCalculationRule,
+            "_commit_health_facility",
+            side_effect=checking_commit,
+        ):
+            # e.g. claim_batch.services.process_batch
+            with transaction.atomic():
+                dataset = create_test_batch_dataset(
+                    facilities=2, claims=2, user=create_test_interactive_user()
+                )
+                batch_run = do_process_batch(
+                    self.user.id_for_audit, dataset["region"].id, dataset["end_date"]
+                )
+                self.assertEqual(committed, [])
+        first_health_facility, second_health_facility = dataset["health_facilities"]
+        self.assertEqual(committed, [[], [first_health_facility.id]])
+        self.assertEqual(
+            self._committed_health_facility_ids(dataset),
+            [first_health_facility.id, second_health_facility.id],
+        )
+        job = ConversionJob.objects.get(batch_run_id=batch_run.id)
+        self.assertEqual(job.status, ConversionJob.STATUS_DONE)
+        self.assertFalse(
+            Claim.objects.filter(
+                id__in=[claim.id for claim in dataset["claims"]],
+                remunerated__isnull=True,
+            ).exists()
+        )
+
+    @staticmethod
+    def _committed_health_facility_ids(dataset):
+        health_facility_ids = []
+
+        def read_committed_bills():
+            try:
+                health_facility_ids.extend(
+                    int(thirdparty_id)
+                    for thirdparty_id in Bill.objects.filter(
+                        thirdparty_id__in=[
+                            str(health_facility.id)
+                            for health_facility in dataset["health_facilities"]
+                        ]
+                    ).values_list("thirdparty_id", flat=True)
+                )
+            finally:
+                connections.close_all()
+
+        thread = threading.Thread(target=read_committed_bills)
+        thread.start()
+        thread.join()
+        return sorted(health_facility_ids)
+
+
+class SimulateValuationTest(BatchRunUserMixin, TestCase):
+    def test_same_index_as_batch_valuation(self):
+        dataset = create_test_batch_dataset(
+            facilities=2, claims=2, user=create_test_interactive_user()
+        )
+        payment_plan = dataset["payment_plan"]
+        end_date = dataset["end_date"]
+        start_date = get_start_date(end_date, payment_plan.periodicity)
+
+        simulation, restricted_simulation = (
+            ThirdPartyPaymentCalculationRule.simulate_valuation(
+                payment_plan,
+                [(start_date, end_date)],
+                # the payment plan parameters, then the hospitals only
+                [{}, {"hf_level_2": "null", "hf_level_3": "null"}],
+            )
+        )
+        self.assertFalse(
+            RelativeIndex.objects.filter(product=dataset["product"]).exists()
+        )
+        self.assertGreater(simulation["relative_total"], 0)
+        self.assertLess(
+            restricted_simulation["relative_total"], simulation["relative_total"]
+        )
+
+        do_process_batch(self.user.id_for_audit, dataset["region"].id, end_date)
+
+        relative_index = RelativeIndex.objects.get(product=dataset["product"])
+        self.assertAlmostEqual(
+            float(relative_index.rel_index), simulation["index"], places=4
+        )
+
+
+class EligibleClaimsTest(TestCase):
+    def test_materialized_staged_and_subquery_claims(self):
+        dataset = create_test_batch_dataset(
+            facilities=2, claims=3, user=create_test_interactive_user()
+        )
+        payment_plan = dataset["payment_plan"]
+        end_date = dataset["end_date"]
+        batch_run = BatchRun.objects.create(
+            location_id=dataset["region"].id,
+            run_year=end_date.year,
+            run_month=end_date.month,
+            run_date=datetime.datetime.now(),
+            audit_user_id=999,
+            validity_from=datetime.datetime.now(),
+        )
+        eligible = {}
+        # subquery, ids list, staged ids (more claims than the list max size)
+        for max_size in [0, 900, 1]:
+            with self.subTest(max_size=max_size), mock.patch.object(
+                CalcruleThirdPartyPaymentConfig,
+                "materialized_claim_ids_max_size",
+                max_size,
+            ):
+                work_data = update_work_data(
+                    {"created_run": batch_run, "product": dataset["product"]},
+                    dataset["product"],
+                    Claim.STATUS_PROCESSED,
+                    get_start_date(end_date, payment_plan.periodicity),
+                    end_date,
+                )[1]
+                work_data = ThirdPartyPaymentCalculationRule.filter_work_data(
+                    work_data, get_compiled_payment_plan(payment_plan)
+                )
+                stage_id = work_data.get("claim_stage_id")
+                self.assertEqual(stage_id is not None, max_size == 1)
+                with release_staged_claims(work_data):
+                    eligible[max_size] = [
+                        set(work_data[queryset].values_list("id", flat=True))
+                        for queryset in ["claims", "items", "services"]
+                    ]
+                    if stage_id:
+                        self.assertEqual(
+                            StagedClaim.objects.filter(stage_id=stage_id).count(),
+                            len(eligible[max_size][0]),
+                        )
+                self.assertFalse(StagedClaim.objects.filter(stage_id=stage_id).exists())
+        self.assertGreater(len(eligible[0][0]), 1)
+        self.assertEqual(eligible[900], eligible[0])
+        self.assertEqual(eligible[1], eligible[0])
+
+
+class StreamingConversionTest(BatchRunUserMixin, TestCase):
+    def test_streaming_batch_run(self):
+        dataset = create_test_batch_dataset(
+            facilities=2, claims=5, user=create_test_interactive_user()
+        )
+        with mock.patch.multiple(
+            CalcruleThirdPartyPaymentConfig,
+            streaming_conversion=True,
+            streaming_chunk_size=2,
+            # streaming takes precedence
+            parallel_conversion=True,
+            per_facility_commit=False,
+            background_conversion=False,
+            bill_max_lines=0,
+            bill_max_amount=0,
+        ), mock.patch.object(
+            ThirdPartyPaymentCalculationRule,
+            "_convert_parallel",
+        ) as convert_parallel:
+            batch_run = do_process_batch(
+                self.user.id_for_audit, dataset["region"].id, dataset["end_date"]
+            )
+        convert_parallel.assert_not_called()
+        for health_facility in dataset["health_facilities"]:
+            bill = Bill.objects.get(
+                subject_id=batch_run.id, thirdparty_id=health_facility.id
+            )
+            line_items = list(bill.line_items_bill.all())
+            self.assertEqual(
+                {line_item.line_id for line_item in line_items},
+                {
+                    str(claim.id)
+                    for claim in dataset["claims"]
+                    if claim.health_facility_id == health_facility.id
+                },
+            )
+            # the details of the claims of each chunk are read with the chunk
+            for line_item in line_items:
+                self.assertEqual(len(line_item.details["claim_details"]), 2)
+            amount_net = sum(line_item.amount_net for line_item in line_items)
+            self.assertEqual(bill.amount_net, amount_net)
+            self.assertEqual(bill.amount_total, amount_net)
+            self.assertEqual(
+                list(Bill.history.filter(id=bill.id).values_list("amount_total")),
+                [(bill.amount_total,)],
+            )
+        self.assertFalse(
+            Claim.objects.filter(
+                id__in=[claim.id for claim in dataset["claims"]],
+                remunerated__isnull=True,
+            ).exists()
+        )
+
+
+class BillSplitTest(BatchRunUserMixin, TestCase):
+    BILL_CODE = "IV-SPLIT-HF-2024-01"
+    LINE_AMOUNTS = [10, 20, 30, 40, 50]
+    # max lines, max amount → code suffix, line item codes and amount of each part
+    SPLITS = [
+        (
+            2,
+            0,
+            [
+                ("-1", ["C0", "C1"], 30),
+                ("-2", ["C2", "C3"], 70),
+                ("-3", ["C4"], 50),
+            ],
+        ),
+        (
+            0,
+            60,
+            [
+                ("-1", ["C0", "C1", "C2"], 60),
+                ("-2", ["C3"], 40),
+                ("-3", ["C4"], 50),
+            ],
+        ),
+        (5, 150, [("", ["C0", "C1", "C2", "C3", "C4"], 150)]),
+    ]
+
+    def test_split_bill(self):
+        # the line items built by the converter, or the dicts accepted before them
+        for as_dicts in [False, True]:
+            for max_lines, max_amount, expected_parts in self.SPLITS:
+                with self.subTest(
+                    as_dicts=as_dicts, max_lines=max_lines, max_amount=max_amount
+                ):
+                    self._assert_split_bill(
+                        self._line_items(as_dicts),
+                        max_lines,
+                        max_amount,
+                        expected_parts,
+                    )
+
+    def test_create_bill_streaming(self):
+        for max_lines, max_amount, expected_parts in self.SPLITS:
+            with self.subTest(max_lines=max_lines, max_amount=max_amount):
+                with transaction.atomic():
+                    bills = create_bill_streaming(
+                        {
+                            "bill_data": self._bill(),
+                            "bill_data_line": iter(self._line_items()),
+                        },
+                        self.user,
+                        chunk_size=2,
+                        max_lines=max_lines,
+                        max_amount=max_amount,
+                    )
+                    saved_parts = []
+                    for bill in Bill.objects.filter(
+                        id__in=[bill.id for bill in bills]
+                    ).order_by("code"):
+                        saved_parts.append(
+                            (
+                                bill.code,
+                                list(
+                                    bill.line_items_bill.order_by("code").values_list(
+                                        "code", flat=True
+                                    )
+                                ),
+                                bill.amount_total,
+                            )
+                        )
+                        # the history row of the bill has its final code and amounts
+                        self.assertEqual(
+                            list(
+                                Bill.history.filter(id=bill.id).values_list(
+                                    "code", "amount_total"
+                                )
+                            ),
+                            [(bill.code, bill.amount_total)],
+                        )
+                    self.assertEqual(saved_parts, self._expected(expected_parts))
+                    transaction.set_rollback(True)
+
+    def _assert_split_bill(
+        self, bill_line_items, max_lines, max_amount, expected_parts
+    ):
+        bill = self._bill()
+        for line_item in bill_line_items:
+            ClaimsToBillConverter.build_amounts(line_item, bill)
+        parts = ClaimsToBillConverter.split_bill(
+            bill, bill_line_items, max_lines, max_amount
+        )
+        self.assertEqual(
+            [
+                (
+                    bill_part["code"],
+                    [line_item["code"] for line_item in line_items],
+                    bill_part["amount_total"],
+                )
+                for bill_part, line_items in parts
+            ],
+            self._expected(expected_parts),
+        )
+
+    def _expected(self, expected_parts):
+        return [
+            (f"{self.BILL_CODE}{suffix}", line_codes, decimal.Decimal(amount))
+            for suffix, line_codes, amount in expected_parts
+        ]
+
+    def _bill(self):
+        bill = {"code": self.BILL_CODE, "date_valid_from": date.today()}
+        ClaimsToBillConverter.build_init_amounts(bill)
+        return bill
+
+    def _line_items(self, as_dicts=False):
+        line_items = []
+        for index, amount in enumerate(self.LINE_AMOUNTS):
+            line_item = BillLineItem()
+            line_item.code = f"C{index}"
+            line_item.date_valid_from = date.today()
+            line_item.quantity = 1
+            line_item.unit_price = decimal.Decimal(amount)
+            line_item.amount_net = decimal.Decimal(amount)
+            line_item.amount_total = decimal.Decimal(amount)
+            line_items.append(line_item.to_dict() if as_dicts else line_item)
+        return line_items
+
+
+class ConversionJobTest(BatchRunUserMixin, TestCase):
+    def test_resume_after_failed_health_facility(self):
+        dataset, job = self._schedule_job()
+        done_health_facility, failed_health_facility = dataset["health_facilities"]
+        commit_health_facility = (
+            ThirdPartyPaymentCalculationRule._commit_health_facility
+        )
+
+        def failing_commit(*args, health_facility=None, **kwargs):
+            if health_facility == failed_health_facility:
+                raise Exception("test failure")
+            return commit_health_facility(
+                *args, health_facility=health_facility, **kwargs
+            )
+
+        with mock.patch.object(
+            ThirdPartyPaymentCalculationRule,
+            "_commit_health_facility",
+            side_effect=failing_commit,
+        ):
+            ThirdPartyPaymentCalculationRule.run_conversion_job(job.id)
+        job.refresh_from_db()
+        self.assertEqual(job.status, ConversionJob.STATUS_FAILED)
+        self.assertEqual(
+            dict(job.checkpoints.values_list("health_facility_id", "status")),
+            {
+                done_health_facility.id: ConversionCheckpoint.STATUS_DONE,
+                failed_health_facility.id: ConversionCheckpoint.STATUS_FAILED,
+            },
+        )
+        self.assertEqual(
+            self._billed_health_facility_ids(job), [done_health_facility.id]
+        )
+        progress = job.get_progress()
+        self.assertEqual(
+            (progress["total"], progress["processed"], progress["done"]), (2, 2, 1)
+        )
+
+        with mock.patch.object(
+            ThirdPartyPaymentCalculationRule,
+            "_commit_health_facility",
+            wraps=commit_health_facility,
+        ) as commit:
+            with mock.patch.object(
+                CalcruleThirdPartyPaymentConfig,
+                "background_conversion_executor",
+                "inline",
+            ), self.captureOnCommitCallbacks(execute=True):
+                ThirdPartyPaymentCalculationRule.resume_conversion_job(job)
+        # the health facility already done is skipped
+        self.assertEqual(
+            [call.kwargs["health_facility"] for call in commit.call_args_list],
+            [failed_health_facility],
+        )
+        job.refresh_from_db()
+        self.assertEqual(job.status, ConversionJob.STATUS_DONE)
+        self.assertEqual(
+            self._billed_health_facility_ids(job),
+            [done_health_facility.id, failed_health_facility.id],
+        )
+        self.assertEqual(job.get_progress()["done"], 2)
+
+    def test_running_job_is_not_run_again(self):
+        dataset, job = self._schedule_job()
+        ConversionJob.objects.filter(id=job.id).update(
+            status=ConversionJob.STATUS_RUNNING
+        )
+        job.refresh_from_db()
+        with mock.patch.object(
+            ThirdPartyPaymentCalculationRule, "_commit_health_facility"
+        ) as commit:
+            with mock.patch.object(
+                CalcruleThirdPartyPaymentConfig,
+                "background_conversion_executor",
+                "inline",
+            ), self.captureOnCommitCallbacks(execute=True):
+                ThirdPartyPaymentCalculationRule.resume_conversion_job(job)
+            ThirdPartyPaymentCalculationRule.run_conversion_job(job.id)
+        commit.assert_not_called()
+        self.assertFalse(job.checkpoints.exists())
+
+    def test_job_run_is_instrumented_and_profiled(self):
+        dataset, job = self._schedule_job()
+        recorded_calculations = []
+        sink = recorded_calculations.append
+        register_instrumentation_sink(sink)
+        try:
+            with tempfile.TemporaryDirectory() as profiling_directory:
+                with mock.patch.multiple(
+                    CalcruleThirdPartyPaymentConfig,
+                    instrumentation=True,
+                    profiling_contexts=["BatchPayment"],
+                    profiling_directory=profiling_directory,
+                ):
+                    ThirdPartyPaymentCalculationRule.run_conversion_job(job.id)
+                profile_files = os.listdir(profiling_directory)
+        finally:
+            unregister_instrumentation_sink(sink)
+        job.refresh_from_db()
+        self.assertEqual(job.status, ConversionJob.STATUS_DONE)
+        self.assertEqual(
+            [recorded["name"] for recorded in recorded_calculations],
+            [f"BatchPayment {dataset['payment_plan'].code}"],
+        )
+        self.assertLessEqual(
+            {"filter_work_data", "product_resolution", "bill_persistence"},
+            set(recorded_calculations[0]["phases"]),
+        )
+        self.assertIn(
+            f"{job.batch_run_id}_BatchPayment_{dataset['payment_plan'].id}.txt",
+            profile_files,
+        )
+
+    def test_get_progress(self):
+        job = ConversionJob.objects.create(
+            batch_run_id=1,
+            payment_plan_id=uuid.uuid4(),
+            product_id=1,
+            start_date=date.today(),
+            end_date=datetime.datetime.now(),
+            status=ConversionJob.STATUS_RUNNING,
+            total=4,
+            date_started=datetime.datetime.now() - datetime.timedelta(seconds=20),
+        )
+        for health_facility_id, status in [
+            (1, ConversionCheckpoint.STATUS_DONE),
+            (2, ConversionCheckpoint.STATUS_FAILED),
+        ]:
+            ConversionCheckpoint.objects.create(
+                job=job, health_facility_id=health_facility_id, status=status
+            )
+        progress = job.get_progress()
+        self.assertEqual(
+            {
+                key: progress[key]
+                for key in ["status", "total", "processed", "done", "failed"]
+            },
+            {
+                "status": ConversionJob.STATUS_RUNNING,
+                "total": 4,
+                "processed": 2,
+                "done": 1,
+                "failed": 1,
+            },
+        )
+        # 2 health facilities in 20 seconds, 2 left
+        self.assertAlmostEqual(progress["eta_seconds"], 20, delta=5)
+
+    def _schedule_job(self):
+        dataset = create_test_batch_dataset(
+            facilities=2, claims=2, user=create_test_interactive_user()
+        )
+        with mock.patch.multiple(
+            CalcruleThirdPartyPaymentConfig,
+            background_conversion=True,
+            background_conversion_executor="inline",
+        ):
+            # the job is only run once committed
+            with self.captureOnCommitCallbacks(execute=False):
+                batch_run = do_process_batch(
+                    self.user.id_for_audit, dataset["region"].id, dataset["end_date"]
+                )
+            job = ConversionJob.objects.get(batch_run_id=batch_run.id)
+        self.assertEqual(job.status, ConversionJob.STATUS_PENDING)
+        return dataset, job
+
+    @staticmethod
+    def _billed_health_facility_ids(job):
+        return sorted(
+            int(thirdparty_id)
+            for thirdparty_id in Bill.objects.filter(
+                subject_id=job.batch_run_id
+            ).values_list("thirdparty_id", flat=True)
+        )
+
+
+class PhaseRecorderTest(SimpleTestCase):
+    def test_nested_phase_time(self):
+        # started, outer, inner, inner end, outer end, stop
+        with mock.patch(
+            "calcrule_third_party_payment.instrumentation.time.perf_counter",
+            side_effect=[0, 1, 3, 7, 8, 10, 10],
+        ):
+            recorder = PhaseRecorder("test")
+            with recorder.phase("outer"):
+                with recorder.phase("inner"):
+                    recorder.add_rows(3)
+            recorder.stop()
+        self.assertEqual(recorder.wall_time, 10)
+        # the time of the nested phase is only counted in the nested phase
+        self.assertEqual(recorder.phases["outer"]["wall_time"], 3)
+        self.assertEqual(recorder.phases["inner"]["wall_time"], 4)
+        self.assertEqual(recorder.phases["outer"]["rows"], 0)
+        self.assertEqual(recorder.phases["inner"]["rows"], 3)
+        self.assertEqual(
+            [recorder.phases[name]["calls"] for name in ["outer", "inner"]], [1, 1]
+        )
+
+
+class InstrumentationTest(TestCase):
+    def test_queries_and_rows(self):
+        with mock.patch.object(
+            CalcruleThirdPartyPaymentConfig, "instrumentation", True
+        ), record_calculation("test") as recorder:
+            with phase("counting"):
+                Claim.objects.count()
+                Claim.objects.exists()
+                add_rows(5)
+            Claim.objects.count()
+        counting = recorder.phases["counting"]
+        self.assertEqual((counting["calls"], counting["queries"]), (1, 2))
+        self.assertEqual(counting["rows"], 5)
+        # queries run outside of any phase
+        self.assertEqual(recorder.phases["other"]["queries"], 1)
+        self.assertIsNotNone(recorder.wall_time)
+
+    def test_disabled(self):
+        with record_calculation("test") as recorder:
+            with phase("counting"):
+                Claim.objects.count()
+                add_rows(5)
+        self.assertIsNone(recorder)
+
+    def test_failing_sink_does_not_break_calculate(self):
+        payment_plan = PaymentPlan(id=uuid.uuid4(), code="TPPI")
+        recorded_calculations = []
+
+        def failing_sink(recorded):
+            raise ValueError("sink failure")
+
+        register_instrumentation_sink(failing_sink)
+        register_instrumentation_sink(recorded_calculations.append)
+        try:
+            with mock.patch.object(
+                ThirdPartyPaymentCalculationRule, "_process_batch_valuation"
+            ) as process_batch_valuation, mock.patch.object(
+                CalcruleThirdPartyPaymentConfig, "instrumentation", True
+            ), self.assertLogs(
+                "calcrule_third_party_payment.instrumentation", "ERROR"
+            ):
+                result = ThirdPartyPaymentCalculationRule.calculate(
+                    payment_plan, context="BatchValuate"
+                )
+        finally:
+            unregister_instrumentation_sink(failing_sink)
+            unregister_instrumentation_sink(recorded_calculations.append)
+        process_batch_valuation.assert_called_once()
+        # the recorded phases are returned along the message
+        self.assertEqual(result["message"], "valuation finished 'fee for service'")
+        self.assertEqual(result["instrumentation"]["name"], "BatchValuate TPPI")
+        self.assertEqual(recorded_calculations, [result["instrumentation"]])
+
+    def test_calculate_result_without_instrumentation(self):
+        payment_plan = PaymentPlan(id=uuid.uuid4(), code="TPPI")
+        with mock.patch.object(
+            ThirdPartyPaymentCalculationRule, "_process_batch_valuation"
+        ):
+            result = ThirdPartyPaymentCalculationRule.calculate(
+                payment_plan, context="BatchValuate"
+            )
+        self.assertEqual(result, "valuation finished 'fee for service'")
+
+
+class ProfilingTest(SimpleTestCase):
+    def setUp(self):
+        super().setUp()
+        self.payment_plan = PaymentPlan(id=uuid.uuid4(), code="TPPP")
+        self.profiling_directory = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.profiling_directory)
+        super().tearDown()
+
+    def _profile_files(self, work_data=None, **config):
+        config.setdefault("profiling_directory", self.profiling_directory)
+        with mock.patch.multiple(CalcruleThirdPartyPaymentConfig, **config):
+            with profile_calculation("BatchPayment", self.payment_plan, work_data):
+                sum(range(1000))
+        return sorted(os.listdir(self.profiling_directory))
+
+    def test_selection(self):
+        other_uuid = str(uuid.uuid4())
+        for config, enabled in [
+            ({"profiling_contexts": ["BatchPayment"]}, True),
+            ({"profiling_contexts": ["BatchValuate"]}, False),
+            (
+                {"profiling_payment_plans": [str(self.payment_plan.id).upper()]},
+                True,
+            ),
+            ({"profiling_payment_plans": [other_uuid]}, False),
+            (
+                {
+                    "profiling_contexts": ["BatchPayment"],
+                    "profiling_directory": None,
+                },
+                False,
+            ),
+        ]:
+            config.setdefault("profiling_directory", self.profiling_directory)
+            with self.subTest(config=config), mock.patch.multiple(
+                CalcruleThirdPartyPaymentConfig, **config
+            ):
+                self.assertEqual(
+                    is_profiling_enabled("BatchPayment", self.payment_plan), enabled
+                )
+
+    def test_not_selected(self):
+        self.assertEqual(self._profile_files(profiling_contexts=["BatchValuate"]), [])
+
+    def test_file_names(self):
+        batch_run = BatchRun(id=42)
+        self.assertEqual(
+            self._profile_files(
+                {"created_run": batch_run}, profiling_contexts=["BatchPayment"]
+            ),
+            [
+                f"42_BatchPayment_{self.payment_plan.id}.prof",
+                f"42_BatchPayment_{self.payment_plan.id}.txt",
+            ],
+        )
+        shutil.rmtree(self.profiling_directory)
+        # the directory is created if needed
+        self.assertEqual(
+            self._profile_files(profiling_payment_plans=[str(self.payment_plan.id)]),
+            [
+                f"no_batch_run_BatchPayment_{self.payment_plan.id}.prof",
+                f"no_batch_run_BatchPayment_{self.payment_plan.id}.txt",
+            ],
+        )
+
+    def test_profiler_already_active(self):
+        with mock.patch(
+            "calcrule_third_party_payment.profiling.cProfile.Profile"
+        ) as profile, self.assertLogs(
+            "calcrule_third_party_payment.profiling", "WARNING"
+        ):
+            profile.return_value.enable.side_effect = ValueError(
+                "Another profiling tool is already active"
+            )
+            profile_files = self._profile_files(profiling_contexts=["BatchPayment"])
+        # only the memory allocations are written
+        self.assertEqual(
+            profile_files, [f"no_batch_run_BatchPayment_{self.payment_plan.id}.txt"]
+        )
+        profile.return_value.disable.assert_not_called()
+
+
+class QueryBudgetTest(BatchRunUserMixin, TestCase):
+    """
+    the number of queries of the calculation rule must not depend on the number of claims.
+    The bills are saved with bulk inserts (bulk_bill_creation): the INSERT statements of
+    the bill items depend on the batch size, capped by the database backend (e.g. under the
+    2100 parameters of SQL Server), so they are not counted. The default BillService path
+    saves each line item and is not covered.
+    """
+
+    CLAIM_COUNTS = (1, 50, 1000)
+
+    def test_query_count_does_not_depend_on_claim_count(self):
+        with mock.patch.multiple(
+            CalcruleThirdPartyPaymentConfig,
+            bulk_bill_creation=True,
+            bulk_bill_creation_chunk_size=0,
+            valuation_update_chunk_size=0,
+            streaming_conversion=False,
+            parallel_conversion=False,
+            per_facility_commit=False,
+        ):
+            small_count, *larger_counts = self.CLAIM_COUNTS
+            small_counts = self._count_queries(small_count)
+            self.assertEqual(
+                set(small_counts),
+                {
+                    "_process_batch_valuation",
+                    "convert_batch",
+                    "check_calculation",
+                    "check_calculation_many",
+                },
+            )
+            for claim_count in larger_counts:
+                counts = self._count_queries(claim_count)
+                for name, count in small_counts.items():
+                    self.assertEqual(
+                        counts[name],
+                        count,
+                        f"{name}: {count} queries for {small_count} claims, "
+                        f"{counts[name]} for {claim_count} claims",
+                    )
+
+    def test_get_linked_class_query_count(self):
+        rebuild_linked_class_map()
+        with self.assertNumQueries(0):
+            linked_classes = ThirdPartyPaymentCalculationRule.get_linked_class(
+                None, "Claim"
+            )
+            ThirdPartyPaymentCalculationRule.get_linked_class(None, None)
+        self.assertIn("HealthFacility", linked_classes)
+        self.assertNotIn("User", linked_classes)
+
+    def _count_queries(self, claim_count):
+        counts = {}
+        with transaction.atomic():
+            dataset = create_test_batch_dataset(
+                claims=claim_count, user=create_test_interactive_user()
+            )
+            patches = [
+                mock.patch.object(
+                    ThirdPartyPaymentCalculationRule,
+                    name,
+                    self._counting(counts, name),
+                )
+                for name in ["convert_batch", "_process_batch_valuation"]
+            ]
+            for patch in patches:
+                patch.start()
+            try:
+                batch_run = do_process_batch(
+                    self.user.id_for_audit, dataset["region"].id, dataset["end_date"]
+                )
+            finally:
+                for patch in patches:
+                    patch.stop()
+            self.assertEqual(
+                BillItem.objects.filter(bill__subject_id=batch_run.id).count(),
+                claim_count,
+            )
+
+            check_calculation_cache.clear()
+            with CaptureQueriesContext(connection) as queries:
+                ThirdPartyPaymentCalculationRule.check_calculation(dataset["claims"][0])
+            counts["check_calculation"] = len(queries)
+            with CaptureQueriesContext(connection) as queries:
+                ThirdPartyPaymentCalculationRule.check_calculation_many(
+                    Claim.objects.filter(
+                        health_facility__in=dataset["health_facilities"]
+                    )
+                )
+            counts["check_calculation_many"] = len(queries)
+            transaction.set_rollback(True)
+        return counts
+
+    @classmethod
+    def _counting(cls, counts, name):
+        method = getattr(ThirdPartyPaymentCalculationRule, name)
+
+        def counting_method(rule, *args, **kwargs):
+            with CaptureQueriesContext(connection) as queries:
+                result = method(*args, **kwargs)
+            counts[name] = counts.get(name, 0) + len(
+                cls._without_bill_item_inserts(queries)
+            )
+            return result
+
+        return classmethod(counting_method)
+
+    @staticmethod
+    def _without_bill_item_inserts(queries):
+        bill_item_tables = [
+            BillItem._meta.db_table,
+            BillItem.history.model._meta.db_table,
+        ]
+        return [
+            query
+            for query in queries
+            if not (
+                query["sql"].lstrip().upper().startswith("INSERT")
+                and any(table in query["sql"] for table in bill_item_tables)
+            )
+        ]
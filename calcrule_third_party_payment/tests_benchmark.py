@@ -0,0 +1,164 @@
+import json
+import os
+import time
+import tracemalloc
+import unittest
+from unittest import mock
+
+from django.db import connection, transaction
+from django.test import TestCase
+from django.test.utils import CaptureQueriesContext
+
+from calcrule_third_party_payment.apps import CalcruleThirdPartyPaymentConfig
+from calcrule_third_party_payment.instrumentation import (
+    register_instrumentation_sink,
+    unregister_instrumentation_sink,
+)
+from calcrule_third_party_payment.test_helpers import (
+    BatchRunUserMixin,
+    create_test_batch_dataset,
+)
+from claim_batch import services as claim_batch_services
+from core.test_helpers import create_test_interactive_user
+
+# comma separated facilities x claims x details scenarios, e.g. "1x10x1,10x100x3"
+BENCHMARK_ENV = "CALCRULE_TPP_BENCHMARK"
+# path of the JSON report
+BENCHMARK_REPORT_ENV = "CALCRULE_TPP_BENCHMARK_REPORT"
+# free label written in the report (e.g. the commit being measured)
+BENCHMARK_LABEL_ENV = "CALCRULE_TPP_BENCHMARK_LABEL"
+DEFAULT_SCENARIOS = "1x10x1,5x50x2,10x100x3"
+
+
+def parse_scenarios(value):
+    if value in ("1", "true", "True"):
+        value = DEFAULT_SCENARIOS
+    return [
+        tuple(int(size) for size in scenario.strip().split("x"))
+        for scenario in value.split(",")
+        if scenario.strip()
+    ]
+
+
+def merge_recorded_phases(recorded_calculations):
+    """sum the phases recorded (see instrumentation.PhaseRecorder) of several calculations"""
+    phases = {}
+    for recorded in recorded_calculations:
+        for name, recorded_phase in recorded["phases"].items():
+            phase = phases.setdefault(name, dict.fromkeys(recorded_phase, 0))
+            for key, value in recorded_phase.items():
+                phase[key] += value
+    return phases
+
+
+@unittest.skipUnless(
+    os.environ.get(BENCHMARK_ENV), f"set {BENCHMARK_ENV} to run the benchmark"
+)
+class BatchRunBenchmark(BatchRunUserMixin, TestCase):
+    """
+    time the BatchValuate and BatchPayment contexts of do_process_batch on generated
+    datasets, the report is written as JSON to CALCRULE_TPP_BENCHMARK_REPORT
+    (default: calcrule_third_party_payment_benchmark.json)
+    """
+
+    test_user_name = "test_batch_benchmark"
+
+    def test_batch_run_benchmark(self):
+        report = {
+            "label": os.environ.get(BENCHMARK_LABEL_ENV),
+            "database": connection.vendor,
+            "scenarios": [],
+        }
+        for facilities, claims, details in parse_scenarios(os.environ[BENCHMARK_ENV]):
+            with self.subTest(facilities=facilities, claims=claims, details=details):
+                report["scenarios"].append(
+                    self._run_scenario(facilities, claims, details)
+                )
+        report_path = os.environ.get(
+            BENCHMARK_REPORT_ENV, "calcrule_third_party_payment_benchmark.json"
+        )
+        with open(report_path, "w") as report_file:
+            json.dump(report, report_file, indent=2)
+
+    def _run_scenario(self, facilities, claims, details):
+        # each scenario is rolled back so that they all start from the same database
+        with transaction.atomic():
+            dataset = create_test_batch_dataset(
+                facilities, claims, details, user=create_test_interactive_user()
+            )
+            # wall time, queries and rows per phase of each calculation, see instrumentation
+            recorded_calculations = []
+            sink = recorded_calculations.append
+            # peak of traced python memory per context
+            peak_memory = {}
+            trigger_calculation_based_on_context = (
+                claim_batch_services.trigger_calculation_based_on_context
+            )
+
+            def measured_trigger(context, *args, **kwargs):
+                peak_memory["total"] = max(
+                    peak_memory.get("total", 0), tracemalloc.get_traced_memory()[1]
+                )
+                tracemalloc.reset_peak()
+                try:
+                    return trigger_calculation_based_on_context(
+                        context, *args, **kwargs
+                    )
+                finally:
+                    context_peak = tracemalloc.get_traced_memory()[1]
+                    peak_memory[context] = max(
+                        peak_memory.get(context, 0), context_peak
+                    )
+                    peak_memory["total"] = max(
+                        peak_memory.get("total", 0), context_peak
+                    )
+
+            register_instrumentation_sink(sink)
+            tracemalloc.start()
+            try:
+                with mock.patch.object(
+                    claim_batch_services,
+                    "trigger_calculation_based_on_context",
+                    measured_trigger,
+                ), mock.patch.object(
+                    CalcruleThirdPartyPaymentConfig, "instrumentation", True
+                ), CaptureQueriesContext(
+                    connection
+                ) as queries:
+                    start = time.perf_counter()
+                    claim_batch_services.do_process_batch(
+                        self.user.id_for_audit,
+                        dataset["region"].id,
+                        dataset["end_date"],
+                    )
+                    wall_time = time.perf_counter() - start
+                peak_memory["total"] = max(
+                    peak_memory.get("total", 0), tracemalloc.get_traced_memory()[1]
+                )
+            finally:
+                tracemalloc.stop()
+                unregister_instrumentation_sink(sink)
+            transaction.set_rollback(True)
+        contexts = {}
+        for context in ["BatchValuate", "BatchPayment"]:
+            context_calculations = [
+                recorded
+                for recorded in recorded_calculations
+                if recorded["name"].startswith(f"{context} ")
+            ]
+            contexts[context] = {
+                "wall_time": sum(
+                    recorded["wall_time"] for recorded in context_calculations
+                ),
+                "peak_memory": peak_memory.get(context, 0),
+                "phases": merge_recorded_phases(context_calculations),
+            }
+        return {
+            "facilities": facilities,
+            "claims_per_facility": claims,
+            "details_per_claim": details,
+            "wall_time": wall_time,
+            "queries": len(queries),
+            "peak_memory": peak_memory["total"],
+            "contexts": contexts,
+        }
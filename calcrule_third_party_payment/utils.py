@@ -1,22 +1,371 @@
+import threading
+import uuid
+from collections import OrderedDict
+from contextlib import contextmanager
+from types import MappingProxyType
+
+from django.apps import apps
+from django.db import connections, transaction
 from django.contrib.contenttypes.models import ContentType
-from django.db.models import F, Q
+from django.db.models import (
+    BooleanField,
+    Case,
+    CharField,
+    Count,
+    DecimalField,
+    Exists,
+    F,
+    Max,
+    OuterRef,
+    Q,
+    Subquery,
+    Sum,
+    Value,
+    When,
+)
+from django.db.models.functions import Cast, Coalesce
 
+from calcrule_third_party_payment.apps import CalcruleThirdPartyPaymentConfig
+from calcrule_third_party_payment.instrumentation import add_rows, phase
+from calcrule_third_party_payment.config import (
+    INTEGER_PARAMETERS,
+    NONE_INTEGER_PARAMETERS,
+)
+from calcrule_third_party_payment.models import StagedClaim
+from claim.models import Claim, ClaimItem, ClaimService
 from claim.subqueries import total_elm_adjusted_exp
-from claim_batch.services import get_contribution_index_rate
-from invoice.models import BillItem
+from claim_batch.models import BatchRun
+from claim_batch.services import (
+    get_contribution_index_rate,
+    get_hospital_claim_filter,
+    update_work_data,
+)
+from contribution_plan.utils import obtain_calcrule_params
+from invoice.models import Bill, BillItem
 from location.models import HealthFacility
 from product.models import Product, ProductItemOrService
 
 
-def check_bill_exist(instance, convert_to, **kwargs):
-    if instance.__class__.__name__ == "QuerySet":
-        queryset_model = instance.model
-        if queryset_model.__name__ == "Claim":
-            claim = instance.first()
-            content_type = ContentType.objects.get_for_model(claim.__class__)
-            bills = BillItem.objects.filter(line_type=content_type, line_id=claim.id)
-            if bills.count() == 0:
-                return True
+class LRUCache(object):
+    """
+    process local, thread safe dict bounded to max_size entries,
+    the least recently used entry is evicted first (max_size 0 disables the cache)
+    """
+
+    def __init__(self, max_size):
+        self.max_size = max_size
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key, default=None):
+        with self._lock:
+            if key not in self._data:
+                return default
+            self._data.move_to_end(key)
+            return self._data[key]
+
+    def set(self, key, value):
+        if not self.max_size:
+            return
+        with self._lock:
+            self._data[key] = value
+            self._data.move_to_end(key)
+            while len(self._data) > self.max_size:
+                self._data.popitem(last=False)
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+    def __len__(self):
+        return len(self._data)
+
+
+# (class name, pk) → result of ThirdPartyPaymentCalculationRule.check_calculation,
+# cleared by the signals receivers when a PaymentPlan, Product, Location or HF is saved
+check_calculation_cache = LRUCache(
+    CalcruleThirdPartyPaymentConfig.check_calculation_cache_size
+)
+
+
+def annotate_claim_product(claims):
+    """
+    annotate the claims with the highest product id of
+    their valid items (item_product_id) and services (service_product_id)
+    """
+    annotations = {}
+    for svc_item, annotation in [
+        (ClaimItem, "item_product_id"),
+        (ClaimService, "service_product_id"),
+    ]:
+        annotations[annotation] = Subquery(
+            svc_item.objects.filter(
+                claim=OuterRef("id"),
+                validity_to__isnull=True,
+                product__isnull=False,
+            )
+            .order_by("-product_id")
+            .values("product_id")[:1]
+        )
+    return claims.annotate(**annotations)
+
+
+class CompiledPaymentPlan(object):
+    """
+    calculation rule parameters of a payment plan parsed once, with the
+    hospital level and claim type filter built once per ceiling interpretation and prefix
+    """
+
+    def __init__(self, payment_plan):
+        # obtain_calcrule_params works on the json_ext of the payment plan, keep a copy
+        self.params = dict(
+            obtain_calcrule_params(
+                payment_plan, INTEGER_PARAMETERS, NONE_INTEGER_PARAMETERS
+            )
+        )
+        self._filters = {}
+
+    def get_filter(self, ceiling_interpretation, prefix=""):
+        key = (ceiling_interpretation, prefix)
+        if key not in self._filters:
+            self._filters[key] = get_hospital_level_filter(
+                self.params, prefix=prefix
+            ) & get_hospital_claim_filter(
+                ceiling_interpretation, self.params["claim_type"], prefix
+            )
+        return self._filters[key]
+
+
+# (payment plan id, version) → CompiledPaymentPlan, cleared when a PaymentPlan is saved
+compiled_payment_plan_cache = LRUCache(100)
+
+
+def get_compiled_payment_plan(payment_plan):
+    key = (payment_plan.id, payment_plan.version)
+    compiled_payment_plan = compiled_payment_plan_cache.get(key)
+    if compiled_payment_plan is None:
+        compiled_payment_plan = CompiledPaymentPlan(payment_plan)
+        compiled_payment_plan_cache.set(key, compiled_payment_plan)
+    return compiled_payment_plan
+
+
+# the claim ids are repeated in some statements (e.g. both arms of the UNION ALL of
+# get_relative_adjusted_total) and SQL Server caps a statement at 2100 parameters
+MAX_MATERIALIZED_CLAIM_IDS = 900
+
+
+def materialize_claim_ids(claims, max_size):
+    """
+    evaluate the ids of the claims queryset once, return them as a list if there are
+    at most max_size (capped to MAX_MATERIALIZED_CLAIM_IDS) of them, None otherwise
+    (or if max_size is 0)
+    """
+    if not max_size:
+        return None
+    max_size = min(max_size, MAX_MATERIALIZED_CLAIM_IDS)
+    claim_ids = list(claims.order_by().values_list("id", flat=True)[: max_size + 1])
+    if len(claim_ids) > max_size:
+        return None
+    return claim_ids
+
+
+def stage_claim_ids(claims):
+    """
+    insert the ids of the claims queryset in the StagedClaim table under a new stage id,
+    with a single INSERT ... SELECT (the ids don't go through python), return the stage id
+    """
+    connection = connections[claims.db]
+    quote_name = connection.ops.quote_name
+    stage_id = uuid.uuid4()
+    stage_id_field = StagedClaim._meta.get_field("stage_id")
+    claim_id_field = StagedClaim._meta.get_field("claim_id")
+    select_sql, select_params = (
+        claims.order_by()
+        .annotate(staged_claim_id=F("id"))
+        .values("staged_claim_id")
+        .query.get_compiler(using=claims.db)
+        .as_sql()
+    )
+    with connection.cursor() as cursor:
+        cursor.execute(
+            f"INSERT INTO {quote_name(StagedClaim._meta.db_table)} "
+            f"({quote_name(stage_id_field.column)}, {quote_name(claim_id_field.column)}) "
+            f"SELECT %s, staged_claims.staged_claim_id FROM ({select_sql}) staged_claims",
+            [stage_id_field.get_db_prep_value(stage_id, connection), *select_params],
+        )
+        add_rows(cursor.rowcount)
+    return stage_id
+
+
+@contextmanager
+def release_staged_claims(work_data):
+    """
+    delete the claim ids staged by filter_work_data once the calculation is done, or has
+    failed (unless its transaction is to be rolled back, the staged ids being rolled back too)
+    """
+    try:
+        yield
+    finally:
+        stage_id = work_data.pop("claim_stage_id", None) if work_data else None
+        if stage_id is not None and not transaction.get_connection().needs_rollback:
+            StagedClaim.objects.filter(stage_id=stage_id).delete()
+
+
+# model name (lower case) → names of the models it has a ForeignKey to (but User),
+# see get_linked_class_map
+_linked_class_map = None
+
+
+def get_linked_class_map():
+    """the read-only map used by get_linked_class, built on first use without database access"""
+    if _linked_class_map is None:
+        rebuild_linked_class_map()
+    return _linked_class_map
+
+
+def rebuild_linked_class_map():
+    """
+    (re)build the linked class map from the installed models (e.g. in tests defining models),
+    when several apps have a model with the same name the first registered one is kept
+    """
+    global _linked_class_map
+    linked_class_map = {}
+    for model in apps.get_models():
+        linked_class_map.setdefault(
+            model._meta.model_name,
+            tuple(
+                f.remote_field.model.__name__
+                for f in model._meta.fields
+                if (
+                    f.get_internal_type() == "ForeignKey"
+                    and f.remote_field.model.__name__ != "User"
+                )
+            ),
+        )
+    _linked_class_map = MappingProxyType(linked_class_map)
+    return _linked_class_map
+
+
+def get_health_facility_products(claims):
+    """
+    return the product of the claims of each health facility (the MAX product id
+    of their items and services) as a {health facility id: Product} dict,
+    each product is loaded once for the whole claims queryset
+    """
+    health_facility_product_ids = {}
+    for svc_item in [ClaimItem, ClaimService]:
+        max_product_ids = (
+            svc_item.objects.filter(claim__in=claims, product__isnull=False)
+            .order_by()
+            .values("claim__health_facility_id")
+            .annotate(product_id=Max("product_id"))
+        )
+        for max_product_id in max_product_ids:
+            health_facility_id = max_product_id["claim__health_facility_id"]
+            health_facility_product_ids[health_facility_id] = max(
+                max_product_id["product_id"],
+                health_facility_product_ids.get(health_facility_id, 0),
+            )
+    products = Product.objects.in_bulk(set(health_facility_product_ids.values()))
+    return {
+        health_facility_id: products[product_id]
+        for health_facility_id, product_id in health_facility_product_ids.items()
+    }
+
+
+def get_billed_claim_ids(claims):
+    """return the set of claim ids (from the claims queryset) already linked to a bill item"""
+    return set(
+        claims.filter(_billed_claim_exists(claims.model)).values_list("id", flat=True)
+    )
+
+
+def has_billed_claims(claims):
+    """whether some claims of the queryset are already linked to a bill item"""
+    return claims.filter(_billed_claim_exists(claims.model)).exists()
+
+
+def get_next_rerun_number(bill_code):
+    """
+    number of the next re-run bill of a partly billed health facility, the re-run bills
+    being coded <bill code>-R<n> (see ClaimsToBillConverter.build_rerun_code)
+    """
+    prefix = f"{bill_code}-R"
+    rerun_numbers = [0]
+    for code in Bill.objects.filter(code__startswith=prefix).values_list(
+        "code", flat=True
+    ):
+        # the re-run bills can be split too (<bill code>-R<n>-<part>)
+        rerun_number = code[len(prefix) :].split("-")[0]
+        if rerun_number.isdigit():
+            rerun_numbers.append(int(rerun_number))
+    return max(rerun_numbers) + 1
+
+
+def _billed_claim_exists(model):
+    content_type = ContentType.objects.get_for_model(model)
+    return Exists(
+        BillItem.objects.filter(
+            line_type=content_type,
+            line_id=Cast(OuterRef("id"), output_field=CharField()),
+        )
+    )
+
+
+def get_health_facility_bill_totals(claims):
+    """
+    totals of the claims not yet billed of each health facility, in one grouped query:
+    {health facility id: {claim_count, claimed, remunerated, deduction, amount_net}}
+    the amounts follow ClaimToBillItemConverter (unit price: claimed, or remunerated if
+    no claimed amount; deduction: claimed - remunerated when both are set)
+    """
+    amount_field = DecimalField(max_digits=18, decimal_places=2)
+    zero = Value(0, output_field=amount_field)
+    claimed = Q(claimed__isnull=False) & ~Q(claimed=0)
+    remunerated = Q(remunerated__isnull=False) & ~Q(remunerated=0)
+    totals = (
+        claims.exclude(_billed_claim_exists(claims.model))
+        .order_by()
+        .values("health_facility_id")
+        .annotate(
+            claim_count=Count("id"),
+            claimed_total=Coalesce(Sum("claimed"), zero),
+            remunerated_total=Coalesce(Sum("remunerated"), zero),
+            deduction=Coalesce(
+                Sum(
+                    Case(
+                        When(
+                            claimed & remunerated, then=F("claimed") - F("remunerated")
+                        ),
+                        default=zero,
+                        output_field=amount_field,
+                    )
+                ),
+                zero,
+            ),
+            amount_net=Coalesce(
+                Sum(
+                    Case(
+                        When(claimed & remunerated, then=F("remunerated")),
+                        When(claimed, then=F("claimed")),
+                        default=Coalesce("remunerated", zero),
+                        output_field=amount_field,
+                    )
+                ),
+                zero,
+            ),
+        )
+    )
+    return {
+        total["health_facility_id"]: {
+            "claim_count": total["claim_count"],
+            "claimed": total["claimed_total"],
+            "remunerated": total["remunerated_total"],
+            "deduction": total["deduction"],
+            "amount_net": total["amount_net"],
+        }
+        for total in totals
+    }
 
 
 def claim_batch_valuation(payment_plan, work_data):
@@ -30,29 +379,203 @@ def claim_batch_valuation(payment_plan, work_data):
     # end_date = work_data["end_date"]
     # claims = work_data["claims"]
     pp_params = work_data["pp_params"]
-    # Sum up all item and service amount
-    value = 0
-    value_items = 0
-    value_services = 0
     index = 0
 
     # if there is no configuration the relative index will be set to 100 %
     if start_date is not None:
-        relative_items = items.filter(price_origin=ProductItemOrService.ORIGIN_RELATIVE)
-        relative_services = services.filter(
-            price_origin=ProductItemOrService.ORIGIN_RELATIVE
-        )
-        value_items = relative_items.aggregate(sum=total_elm_adjusted_exp())
-        value_services = relative_services.aggregate(sum=total_elm_adjusted_exp())
-        if "sum" in value_items:
-            value += value_items["sum"] if value_items["sum"] else 0
-        if "sum" in value_services:
-            value += value_services["sum"] if value_services["sum"] else 0
+        with phase("valuation_aggregates"):
+            # Sum up all item and service amount
+            value = get_relative_adjusted_total(items, services)
+            index, distr = get_contribution_index_rate(value, pp_params, work_data)
+        # update the item and services
+        with phase("valuation_updates"):
+            chunk_size = CalcruleThirdPartyPaymentConfig.valuation_update_chunk_size
+            for queryset in [items, services]:
+                for chunk in iter_pk_range_chunks(queryset, chunk_size):
+                    add_rows(chunk.update(price_valuated=F("price_adjusted") * index))
+
+
+def get_relative_adjusted_total(items, services):
+    """
+    sum of the adjusted amount of the relative priced items and services,
+    both sums are computed in a single round-trip (UNION ALL)
+    """
+    relative_sums = [
+        queryset.filter(price_origin=ProductItemOrService.ORIGIN_RELATIVE)
+        .order_by()
+        .values("price_origin")
+        .annotate(sum=total_elm_adjusted_exp())
+        .values("sum")
+        for queryset in [items, services]
+    ]
+    return sum(
+        relative_sum["sum"] or 0
+        for relative_sum in relative_sums[0].union(relative_sums[1], all=True)
+    )
+
 
+def iter_pk_range_chunks(queryset, chunk_size):
+    """
+    split the queryset in querysets of at most chunk_size rows, each one limited
+    to a primary key range; the next range is looked up once the previous chunk is consumed
+    so rows leaving the queryset (e.g. updated status) are handled. chunk_size 0 yields the queryset
+    """
+    if not chunk_size:
+        yield queryset
+        return
+    queryset = queryset.order_by("pk")
+    lower_pk = None
+    while True:
+        chunk = queryset if lower_pk is None else queryset.filter(pk__gt=lower_pk)
+        upper_pk = list(chunk.values_list("pk", flat=True)[chunk_size - 1 : chunk_size])
+        if not upper_pk:
+            yield chunk
+            return
+        yield chunk.filter(pk__lte=upper_pk[0])
+        lower_pk = upper_pk[0]
+
+
+def compute_contribution_index(value, pp_params, work_data):
+    """
+    index and distribution of claim_batch.services.get_contribution_index_rate,
+    the RelativeIndex it saves being rolled back
+    """
+    with transaction.atomic():
         index, distr = get_contribution_index_rate(value, pp_params, work_data)
-        # update the item and services
-        items.update(price_valuated=F("price_adjusted") * index)
-        services.update(price_valuated=F("price_adjusted") * index)
+        transaction.set_rollback(True)
+    return index, distr
+
+
+def simulate_claim_batch_valuation(payment_plan, periods, candidates, audit_user_id=-1):
+    """
+    read only what-if of claim_batch_valuation: for each period (start date, end date)
+    and each candidate parameters (dict overriding the payment plan calculation rule
+    parameters, e.g. distr_x, hf_level_x, claim_type) return the index, the relative total
+    and the projected paid amount of the processed claims not yet valuated.
+    The work data of each period is built as for BatchValuate and its items and services
+    are aggregated once for all the candidates.
+    """
+    product = payment_plan.benefit_plan
+    base_params = get_compiled_payment_plan(payment_plan).params
+    candidates_params = [
+        normalize_calcrule_params({**base_params, **candidate})
+        for candidate in candidates
+    ]
+    allocated_contribution = None
+    results = []
+    for start_date, end_date in periods:
+        work_data = {"created_run": None, "product": product, "end_date": end_date}
+        allocated_contribution, work_data = update_work_data(
+            work_data,
+            product,
+            Claim.STATUS_PROCESSED,
+            start_date,
+            end_date,
+            allocated_contribution,
+        )
+        # audit user of the (rolled back) RelativeIndex, see compute_contribution_index
+        work_data["created_run"] = BatchRun(audit_user_id=audit_user_id)
+        work_data["periodicity"] = payment_plan.periodicity
+        valuation_groups = []
+        for queryset in [work_data["items"], work_data["services"]]:
+            valuation_groups += list(
+                get_valuation_groups(queryset, product.ceiling_interpretation)
+            )
+        for candidate, pp_params in zip(candidates, candidates_params):
+            relative_total = 0
+            adjusted_total = 0
+            for group in valuation_groups:
+                if not is_valuation_group_eligible(group, pp_params):
+                    continue
+                adjusted_total += group["price_adjusted"] or 0
+                if group["price_origin"] == ProductItemOrService.ORIGIN_RELATIVE:
+                    relative_total += group["adjusted"] or 0
+            index, distr = compute_contribution_index(
+                relative_total, pp_params, work_data
+            )
+            results.append(
+                {
+                    "start_date": start_date,
+                    "end_date": end_date,
+                    "candidate": candidate,
+                    "index": index,
+                    "distr": distr,
+                    "relative_total": relative_total,
+                    "paid_amount": float(adjusted_total) * index,
+                }
+            )
+    return results
+
+
+def get_valuation_groups(queryset, ceiling_interpretation):
+    """
+    group the claim items (or services) by health facility level/sub level,
+    hospital claim and price origin with their adjusted amount and adjusted price sums
+    """
+    if ceiling_interpretation == Product.CEILING_INTERPRETATION_HOSPITAL:
+        is_hospital = Case(
+            When(
+                claim__health_facility__level=HealthFacility.LEVEL_HOSPITAL,
+                then=Value(True),
+            ),
+            default=Value(False),
+            output_field=BooleanField(),
+        )
+    else:
+        is_hospital = Case(
+            When(
+                claim__date_to__isnull=False,
+                claim__date_to__gt=F("claim__date_from"),
+                then=Value(True),
+            ),
+            default=Value(False),
+            output_field=BooleanField(),
+        )
+    return (
+        queryset.order_by()
+        .annotate(is_hospital=is_hospital)
+        .values(
+            "claim__health_facility__level",
+            "claim__health_facility__sub_level",
+            "is_hospital",
+            "price_origin",
+        )
+        .annotate(
+            adjusted=total_elm_adjusted_exp(), price_adjusted=Sum("price_adjusted")
+        )
+    )
+
+
+def is_valuation_group_eligible(group, pp_params):
+    # python version of the get_hospital_level_filter and get_hospital_claim_filter
+    level = group["claim__health_facility__level"]
+    sub_level = group["claim__health_facility__sub_level"]
+    levels = [
+        (pp_params[f"hf_level_{i}"], pp_params[f"hf_sublevel_{i}"])
+        for i in range(1, 5)
+        if pp_params[f"hf_level_{i}"]
+    ]
+    if levels and not any(
+        level == hf_level and (not hf_sublevel or sub_level == hf_sublevel)
+        for hf_level, hf_sublevel in levels
+    ):
+        return False
+    if pp_params["claim_type"] == "I":
+        return group["is_hospital"]
+    elif pp_params["claim_type"] == "O":
+        return not group["is_hospital"]
+    return True
+
+
+def normalize_calcrule_params(pp_params):
+    # same typing as contribution_plan.utils.obtain_calcrule_params
+    for key in INTEGER_PARAMETERS:
+        value = pp_params.get(key)
+        pp_params[key] = int(value) if value not in [None, ""] else 0
+    for key in NONE_INTEGER_PARAMETERS:
+        value = pp_params.get(key)
+        pp_params[key] = None if value == "null" else value
+    return pp_params
 
 
 def is_hospital_claim(product, claim):